@@ -7,7 +7,7 @@ __author__ = 'ZsnnsZ'
 JSON API definition.
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 class Page(object):
     '''
@@ -18,14 +18,28 @@ class Page(object):
     # item_count：要显示的条目数量
     # page_index：要显示的是第几页
     # page_size：每页的条目数量
-    def __init__(self, item_count, page_index=1, page_size=5):
+    # cursor：由上一页返回的游标(next_cursor/prev_cursor)，不为空时按(created_at, id)定位而不再使用offset
+    def __init__(self, item_count, page_index=1, page_size=5, cursor=None):
         '''
-        Init Pagination by item_count, page_index and page_size.
+        Init Pagination by item_count, page_index and page_size, or by an opaque cursor.
         '''
         self.item_count = item_count
         self.page_size = page_size
         self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)# //表示整除，%表示取余
-        if (item_count == 0) or (page_index > self.page_count):
+        self.cursor = cursor
+        self.next_cursor = None
+        self.prev_cursor = None
+        self.seek = None
+        self.reverse = False
+        if cursor:
+            # 游标模式：offset恒为0，多取一条用来判断前/后是否还有数据
+            direction, page_index, created_at, pk = decode_cursor(cursor)
+            self.page_index = page_index
+            self.seek = (created_at, pk)
+            self.reverse = direction == 'p'
+            self.offset = 0
+            self.limit = self.page_size + 1
+        elif (item_count == 0) or (page_index > self.page_count):
             self.offset = 0
             self.limit = 0
             self.page_index = 1
@@ -36,11 +50,48 @@ class Page(object):
         self.has_next = self.page_index < self.page_count
         self.has_previous = self.page_index > 1
 
+    def paginate(self, items):
+        '''
+        Trim the rows fetched for this page and fill in next_cursor / prev_cursor.
+        '''
+        if self.cursor:
+            more = len(items) > self.page_size
+            if self.reverse:
+                # 向前翻页时多取的一条在最前面
+                items = items[-self.page_size:] if more else items
+                self.has_previous = more
+                self.has_next = True
+            else:
+                items = items[:self.page_size]
+                self.has_next = more
+                self.has_previous = True
+        if items:
+            first, last = items[0], items[-1]
+            if self.has_next:
+                self.next_cursor = encode_cursor('n', self.page_index + 1, last.created_at, last.id)
+            if self.has_previous:
+                self.prev_cursor = encode_cursor('p', self.page_index - 1, first.created_at, first.id)
+        return items
+
     def __str__(self):
         return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
 
     __repr__ = __str__
 
+# 游标格式：方向(n/p):页码:created_at:id，再做一次urlsafe的base64，对客户端来说是不透明的
+def encode_cursor(direction, page_index, created_at, pk):
+    s = '%s:%d:%r:%s' % (direction, page_index, created_at, pk)
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        direction, page_index, created_at, pk = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split(':', 3)
+        if direction not in ('n', 'p'):
+            raise ValueError('bad direction: %s' % direction)
+        return direction, max(int(page_index), 1), float(created_at), pk
+    except Exception as e:
+        raise APIValueError('cursor', 'Invalid cursor.')
+
 class APIError(Exception):
     '''
     the base APIError which contains error(required), data(optional) and message(optional).
@@ -10,18 +10,24 @@ async web application.
 
 import logging; logging.basicConfig(level=logging.INFO)
 
-import asyncio, os, json, time
+import asyncio, os, time
 from datetime import datetime
+from urllib import parse
 
 from aiohttp import web
-from jinja2 import Environment,FileSystemLoader
+from jinja2 import Environment,FileSystemLoader,FileSystemBytecodeCache
 
 import www.orm
 from www.coroweb import add_routes, add_static
-from www.handlers import cookie2user, COOKIE_NAME
+from www.serializers import dumps
+from www.handlers import cookie2user, COOKIE_NAME, PAGE_CACHE
 
+# production=True时不再检查模板文件是否修改，编译结果存到bytecode_dir(None为系统临时目录)供各进程共用，
+# 并在启动时把所有模板都编译一遍，第一个请求不用再等编译
+# stream=True时用异步模式编译模板，页面边渲染边发送(见stream_template)
 def init_jinja2(app, **kw):
     logging.info('init jinja2...')
+    production = kw.get('production', False)
     # 设置解析模板需要用到的环境变量
     options = dict(
         autoescape = kw.get('autoescape', True),
@@ -29,8 +35,14 @@ def init_jinja2(app, **kw):
         block_end_string = kw.get('block_end_string', '%}'),
         variable_start_string = kw.get('variable_start_string', '{{'),
         variable_end_string = kw.get('variable_end_string', '}}'),
-        auto_reload = kw.get('auto_reload', True)
+        auto_reload = kw.get('auto_reload', not production),
+        enable_async = kw.get('stream', False)
     )
+    if production:
+        bytecode_dir = kw.get('bytecode_dir', None)
+        if bytecode_dir is not None:
+            os.makedirs(bytecode_dir, exist_ok=True)
+        options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_dir)
     path = kw.get('path', None)
     if path is None:
         # 下面这句代码其实是三个步骤，先取当前文件也就是app.py的绝对路径，然后取这个绝对路径的目录部分，最后在这个目录后面加上templates子目录
@@ -42,9 +54,21 @@ def init_jinja2(app, **kw):
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    if production:
+        precompile_templates(env)
     app['__templating__'] = env
 
-@asyncio.coroutine
+# 加载(编译)所有模板并打印每个模板的耗时；有bytecode缓存时只是从缓存读出
+def precompile_templates(env):
+    start, times = time.time(), []
+    for name in env.list_templates(extensions=('html',)):
+        t = time.time()
+        env.get_template(name)
+        times.append((time.time() - t, name))
+    for t, name in sorted(times, reverse=True):
+        logging.info('template %s: %.1fms' % (name, t * 1000))
+    logging.info('%s templates compiled in %.1fms' % (len(times), (time.time() - start) * 1000))
+
 def logger_factory(app, handler):
     @asyncio.coroutine
     def logger(request):
@@ -53,7 +77,17 @@ def logger_factory(app, handler):
         return (yield from handler(request))
     return logger
 
-@asyncio.coroutine
+# 写主库后读主库只在本次请求内有效
+def sticky_factory(app, handler):
+    @asyncio.coroutine
+    def sticky(request):
+        token = www.orm.begin_sticky()
+        try:
+            return (yield from handler(request))
+        finally:
+            www.orm.end_sticky(token)
+    return sticky
+
 def data_factory(app, handler):
     @asyncio.coroutine
     def parse_data(request):
@@ -67,7 +101,6 @@ def data_factory(app, handler):
         return (yield from handler(request))
     return parse_data
 
-@asyncio.coroutine
 def auth_factory(app, handler):
     @asyncio.coroutine
     def auth(request):
@@ -82,7 +115,125 @@ def auth_factory(app, handler):
         return (yield from handler(request))
     return auth
 
+# 匿名用户的GET请求直接返回缓存的整页，不查库也不渲染模板，写操作时由handlers按path失效
+def cache_factory(app, handler):
+    @asyncio.coroutine
+    def cache(request):
+        if request.method != 'GET' or getattr(request, '__user__', None) is not None:
+            return (yield from handler(request))
+        key = (request.path, request.query_string)
+        page = PAGE_CACHE.get(key)
+        if page is not None:
+            content_type, charset, body = page
+            resp = web.Response(body=body)
+            resp.content_type = content_type
+            resp.charset = charset
+            return resp
+        version = PAGE_CACHE.version(request.path)
+        # 页面刚失效时从库可能还没同步到这次写入，这次重新渲染读主库，免得把旧数据缓存一整个ttl
+        if time.time() - PAGE_CACHE.invalidated_at(request.path) < configs.db.replica_lag:
+            www.orm.stick_to_primary()
+        resp = yield from handler(request)
+        # 流式渲染的页面已经发完了，stream_template把整页内容留在__body__上
+        body = resp.body if type(resp) is web.Response else getattr(resp, '__body__', None)
+        # 渲染期间页面被invalidate_pages()过，渲染用的可能是旧数据，不缓存
+        if resp.status == 200 and body is not None and PAGE_CACHE.version(request.path) == version:
+            PAGE_CACHE.set(key, (resp.content_type, resp.charset, body), tags=(request.path,))
+        return resp
+    return cache
+
+# 每个请求一个Loader，handler通过request.__loader__按主键批量加载，同一请求内同一行只查一次
+def loader_factory(app, handler):
+    @asyncio.coroutine
+    def loader(request):
+        request.__loader__ = www.orm.Loader()
+        return (yield from handler(request))
+    return loader
+
+# 流式输出时攒够这么多字节写一次
+STREAM_CHUNK = 16 * 1024
+
+# aiohttp 3的write()是协程，之前的版本要再drain()
+@asyncio.coroutine
+def write(resp, data):
+    w = resp.write(data)
+    yield from (w if w is not None else resp.drain())
+
+# handler返回异步迭代器时逐行编码、分块写出，不在内存里拼整个响应
+# 默认输出JSON数组，?format=ndjson、Accept: application/x-ndjson或迭代器的ndjson属性为True时每行一个JSON
 @asyncio.coroutine
+def stream_response(request, rows):
+    ndjson = getattr(rows, 'ndjson', False) or parse.parse_qs(request.query_string).get('format') == ['ndjson'] or 'application/x-ndjson' in request.headers.get('Accept', '')
+    resp = web.StreamResponse()
+    resp.content_type = 'application/x-ndjson' if ndjson else 'application/json'
+    resp.charset = 'utf-8'
+    resp.enable_chunked_encoding()
+    yield from resp.prepare(request)
+    it = rows.__aiter__()
+    buf, size, first = [] if ndjson else [b'['], 0, True
+    try:
+        while True:
+            try:
+                row = yield from it.__anext__()
+            except StopAsyncIteration:
+                break
+            data = dumps(row)
+            if ndjson:
+                buf.append(data)
+                buf.append(b'\n')
+            else:
+                if not first:
+                    buf.append(b',')
+                buf.append(data)
+            first = False
+            size += len(data) + 1
+            if size >= STREAM_CHUNK:
+                yield from write(resp, b''.join(buf))
+                buf, size = [], 0
+    finally:
+        # 客户端断开时也要让迭代器释放它占用的连接
+        if hasattr(it, 'aclose'):
+            yield from it.aclose()
+    if not ndjson:
+        buf.append(b']')
+    yield from write(resp, b''.join(buf))
+    yield from resp.write_eof()
+    return resp
+
+# 模板边渲染边发送：</head>之前的部分一渲染完就发出去，浏览器可以先去加载css、js，
+# 之后攒够STREAM_CHUNK发一次，每次发送后让出事件循环，长页面的渲染不会一直占着它
+@asyncio.coroutine
+def stream_template(request, template, r):
+    resp = web.StreamResponse()
+    resp.content_type = 'text/html'
+    resp.charset = 'utf-8'
+    resp.enable_chunked_encoding()
+    yield from resp.prepare(request)
+    it = template.generate_async(**r).__aiter__()
+    body, buf, size = [], [], 0
+    try:
+        while True:
+            try:
+                s = yield from it.__anext__()
+            except StopAsyncIteration:
+                break
+            buf.append(s)
+            size += len(s)
+            if size >= STREAM_CHUNK or '</head>' in s:
+                data = ''.join(buf).encode('utf-8')
+                body.append(data)
+                yield from write(resp, data)
+                buf, size = [], 0
+                yield from asyncio.sleep(0)
+    finally:
+        yield from it.aclose()
+    data = ''.join(buf).encode('utf-8')
+    body.append(data)
+    yield from write(resp, data)
+    yield from resp.write_eof()
+    resp.__body__ = b''.join(body)
+    return resp
+
 def response_factory(app, handler):
     @asyncio.coroutine
     def response(request):
@@ -90,6 +241,8 @@ def response_factory(app, handler):
         r = yield from handler(request)# 调用handler来处理url请求,并返回响应结果
         if isinstance(r, web.StreamResponse):
             return r# StreamResponse是aiohttp定义response的基类,即所有响应类型都继承自该类
+        if hasattr(r, '__aiter__'):
+            return (yield from stream_response(request, r))
         if isinstance(r, bytes):
             resp = web.Response(body=r)
             resp.content_type = 'application/octet-stream'
@@ -103,12 +256,15 @@ def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=dumps(r))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
-                r['__user__'] = request.__user__
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
+                r['__user__'] = getattr(request, '__user__', None)
+                env = app['__templating__']
+                if env.is_async:
+                    return (yield from stream_template(request, env.get_template(template), r))
+                resp = web.Response(body=env.get_template(template).render(**r).encode('utf-8'))
                 resp.content_type = 'text/html;charset=utf-8'
                 return resp
         if isinstance(r, int) and r >= 100 and r < 600:
@@ -139,11 +295,20 @@ def datetime_filter(t):
 @asyncio.coroutine
 def init(loop):
     yield from www.orm.create_pool(loop=loop, **configs.db)
-    app = web.Application(loop=loop, middlewares=(
-        logger_factory,auth_factory, response_factory
+    www.orm.enable_explain(configs.debug)
+    if configs.query_cache.enabled:
+        www.orm.enable_query_cache(configs.query_cache.maxsize, configs.query_cache.maxbytes, configs.query_cache.ttl)
+    if configs.counters.resync_interval:
+        asyncio.ensure_future(www.orm.resync_counters_every(configs.counters.resync_interval), loop=loop)
+    if configs.db.replicas:
+        asyncio.ensure_future(www.orm.check_replicas_every(configs.db.replica_check_interval), loop=loop)
+    asyncio.ensure_future(www.orm.tune_pools_every(configs.db.pool_tune_interval), loop=loop)
+    app = web.Application(loop=loop)
+    init_jinja2(app, filters=dict(datetime=datetime_filter), production=configs.templates.production, bytecode_dir=configs.templates.bytecode_dir, stream=configs.templates.stream)
+    # middleware在注册路由时按每个路由的skip套好，静态文件不经过middleware
+    add_routes(app, 'handlers', middlewares=(
+        logger_factory, sticky_factory, auth_factory, cache_factory, loader_factory, response_factory
     ))
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
-    add_routes(app, 'handlers')
     add_static(app)
     server = yield from loop.create_server(app.make_handler(), '127.0.0.1', 9000)
     logging.info('server started at http://127.0.0.1:9000...')
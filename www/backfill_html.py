@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'ZsnnsZ'
+
+'''
+Backfill html_content for blogs and comments saved before render-at-write.
+'''
+
+import www.orm
+import asyncio, sys, logging; logging.basicConfig(level=logging.INFO)
+from www.config import configs
+from www.models import Blog, Comment
+from www.handlers import blog2html, comment2html
+
+BATCH_SIZE = 100
+
+# 按(created_at, id)逐批往后取还没有html_content的行，渲染后一批一起写回
+@asyncio.coroutine
+def backfill(model, render):
+    seek, total = None, 0
+    while True:
+        rows = yield from model.findAll("html_content is null or html_content=''", orderBy='created_at desc, id desc', seek=seek, limit=BATCH_SIZE)
+        if not rows:
+            break
+        for r in rows:
+            r.html_content = render(r.content)
+        yield from model.update_many(rows)
+        total += len(rows)
+        seek = (rows[-1].created_at, rows[-1].id)
+    logging.info('backfilled %s rows in %s' % (total, model.__table__))
+
+@asyncio.coroutine
+def main(loop):
+    yield from www.orm.create_pool(loop=loop, **configs.db)
+    yield from backfill(Blog, blog2html)
+    yield from backfill(Comment, comment2html)
+
+loop = asyncio.get_event_loop()
+loop.run_until_complete(main(loop))
+loop.close()
+if loop.is_closed():
+    sys.exit(0)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'ZsnnsZ'
+
+'''
+In-process LRU cache with TTL and tag-based invalidation.
+'''
+
+import time
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    '''
+    Bounded LRU cache, entries expire after ttl seconds (ttl=None means never).
+    Entries may carry tags, invalidate(tag) drops every entry with that tag.
+    With maxbytes set, the sizes passed to set() are also kept under that cap.
+    '''
+
+    def __init__(self, maxsize=1024, ttl=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()# key -> (过期时间, value, tags, size)
+        self._tags = dict()# tag -> 带有该tag的key
+        self._versions = dict()# tag -> invalidate()的次数
+        self._invalidated_at = dict()# tag -> 最近一次invalidate()的时间
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires, value = item[0], item[1]
+        if expires is not None and expires < time.time():
+            self.pop(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)# 最近访问的放到末尾，淘汰时从头部开始
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None, tags=(), size=0):
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        ttl = ttl if ttl is not None else self.ttl
+        self.pop(key)
+        self._data[key] = (time.time() + ttl if ttl is not None else None, value, tuple(tags), size)
+        self.bytes += size
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._data) > self.maxsize or (self.maxbytes is not None and self.bytes > self.maxbytes):
+            self.pop(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        if item is None:
+            return default
+        self.bytes -= item[3]
+        for tag in item[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+        return item[1]
+
+    def invalidate(self, tag):
+        self._versions[tag] = self._versions.get(tag, 0) + 1
+        self._invalidated_at[tag] = time.time()
+        for key in list(self._tags.get(tag, ())):
+            self.pop(key)
+
+    # 计算值之前取一次，set()之前再比较：变了说明计算期间数据已经失效，结果不该再缓存
+    def version(self, tag):
+        return self._versions.get(tag, 0)
+
+    def invalidated_at(self, tag):
+        return self._invalidated_at.get(tag, 0)
+
+    def clear(self):
+        self._data.clear()
+        self._tags.clear()
+        self.bytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self._data), maxsize=self.maxsize, bytes=self.bytes, maxbytes=self.maxbytes, hits=self.hits, misses=self.misses, hit_rate=float(self.hits) / total if total else 0.0)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
@@ -9,14 +9,45 @@ __author__ = 'James Z'
 
 configs = {
     'debug': True,
+    'templates': {
+        'production': False, # 为True时不检查模板修改、启动时预编译所有模板
+        'bytecode_dir': None, # 模板编译结果的缓存目录，None为系统临时目录
+        'stream': False # 为True时页面边渲染边发送，缩短首字节时间
+    },
     'db': {
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'root',
         'password': '177288',
-        'db': 'awesome'
+        'db': 'awesome',
+        'minsize': 1,
+        'maxsize': 10,
+        'adaptive': False, # 为True时连接数在minsize和maxsize之间按等待时间自动调整
+        'pool_tune_interval': 5, # 自适应调整的周期(秒)
+        'acquire_timeout': 5, # 取连接的超时(秒)，None表示一直等
+        'query_timeout': 30, # 单条sql的超时(秒)，None表示不限
+        'replicas': [], # 只读从库，例如[{'host': '10.0.0.2'}]，其余配置沿用主库
+        'replica_policy': 'round_robin', # 或least_busy
+        'replica_check_interval': 10, # 从库健康检查的间隔(秒)
+        'replica_lag': 1, # 从库复制延迟的上限(秒)，写之后这段时间内读到的结果不进缓存
+        'shards': {} # 分片组名 -> 各分片配置，例如'comments': [{'db': 'awesome_c0'}, {'db': 'awesome_c1'}]
     },
     'session': {
-        'secret': 'Awesome'
+        'secret': 'Awesome',
+        'cache_size': 1024, # 会话缓存最多保存的cookie数
+        'cache_ttl': 300 # 会话缓存的有效期(秒)
+    },
+    'page_cache': {
+        'maxsize': 1000, # 最多缓存的页面数
+        'ttl': 600 # 页面缓存的有效期(秒)
+    },
+    'query_cache': {
+        'enabled': False, # select结果缓存，默认关闭
+        'maxsize': 10000, # 最多缓存的结果集数
+        'maxbytes': 64 * 1024 * 1024, # 缓存大致占用的字节数上限
+        'ttl': 60 # 有效期(秒)，多进程部署时别的进程的写入最多这么久之后可见
+    },
+    'counters': {
+        'resync_interval': 300 # 行数计数器重新统计的间隔(秒)，0表示不定期统计
     }
 }
\ No newline at end of file
@@ -11,7 +11,9 @@ from aiohttp import web
 
 from www.apis import APIError
 
-def get(path):# 装饰器的名称并接收参数，
+# skip：该路由不需要的middleware名字，例如skip=('auth',)，名字是middleware工厂函数名去掉'_factory'
+# cache：是否给匿名用户缓存整页，为False时跳过名为cache的middleware
+def get(path, *, skip=(), cache=False):# 装饰器的名称并接收参数，
     '''
     Define decorator @get('/path')
     在代码运行阶段为函数动态增强功能
@@ -22,10 +24,11 @@ def get(path):# 装饰器的名称并接收参数，
             return func(*args, **kw)# 原函数
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
+        wrapper.__skip__ = tuple(skip) if cache else tuple(skip) + ('cache',)
         return wrapper
     return decorator
 
-def post(path):
+def post(path, *, skip=()):
     '''
     Define decorator @post('/path')
     '''
@@ -35,9 +38,22 @@ def post(path):
             return func(*args, **kw)
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
+        wrapper.__skip__ = tuple(skip) + ('cache',)
         return wrapper
     return decorator
 
+def middleware_name(factory):
+    name = factory.__name__
+    return name[:-len('_factory')] if name.endswith('_factory') else name
+
+# 在注册路由时就把该路由需要的middleware套好，请求时不必再逐个调用工厂函数
+def apply_middlewares(app, handler, middlewares, skip=()):
+    for factory in reversed(middlewares):
+        if middleware_name(factory) in skip:
+            continue
+        handler = factory(app, handler)
+    return handler
+
 # revise关键字参数&命名关键字参数
 # *args是可变参数，args接收的是一个tuple；
 # **kw是关键字参数，kw接收的是一个dict。
@@ -166,13 +182,14 @@ class RequestHandler(object):
             return dict(error=e.error, data=e.data, message=e.message)
 
 # 向app中添加静态文件目录
+# 静态文件默认不经过任何middleware：不解析cookie、不查用户，也不打请求日志
 def add_static(app):
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
     app.router.add_static('/static/', path)
     logging.info('add static %s => %s' % ('/static/', path))
 
 # 把请求处理函数注册到app
-def add_route(app, fn):
+def add_route(app, fn, middlewares=()):
     method = getattr(fn, '__method__', None)
     path = getattr(fn, '__route__', None)
     if path is None or method is None:
@@ -180,10 +197,13 @@ def add_route(app, fn):
     if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
         fn = asyncio.coroutine(fn)
     logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    skip = getattr(fn, '__skip__', ('cache',))
+    if skip:
+        logging.info('  skip middlewares: %s' % ', '.join(skip))
+    app.router.add_route(method, path, apply_middlewares(app, RequestHandler(app, fn), middlewares, skip))
 
 # 将handlers模块中所有请求处理函数提取出来交给add_route去处理
-def add_routes(app, module_name):
+def add_routes(app, module_name, middlewares=()):
     # n = module_name.rfind('.')
     # if n == (-1):
     #     mod = __import__(module_name, globals(), locals())
@@ -202,4 +222,4 @@ def add_routes(app, module_name):
             method = getattr(fn, '__method__', None)# fn.__method
             path = getattr(fn, '__route__', None)
             if method and path:
-                add_route(app, fn)
\ No newline at end of file
+                add_route(app, fn, middlewares)
\ No newline at end of file
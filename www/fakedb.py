@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'ZsnnsZ'
+
+'''
+sqlite-backed stand-ins for aiomysql pools, used by the tests.
+
+Every FakePool is a separate in-memory database, so a few of them stand in
+for a primary, its replicas or the schemas of a shard group.
+'''
+
+import asyncio, sqlite3
+
+import aiomysql
+
+import www.orm
+
+# 按model的__mappings__建表，sqlite不认MySQL的列类型，这里都不写类型
+def create_table(db, model):
+    cols = [model.__primary_key__] + list(model.__fields__)
+    db.execute('create table `%s` (%s, primary key (`%s`))' % (model.__table__, ', '.join(['`%s`' % c for c in cols]), model.__primary_key__))
+
+class FakeCursor(object):
+
+    def __init__(self, conn, dict_rows):
+        self.conn = conn
+        self.dict_rows = dict_rows
+        self.rowcount = 0
+        self._rows = []
+
+    @asyncio.coroutine
+    def execute(self, sql, args=None):
+        self.conn.pool.queries.append(sql)
+        if self.conn.pool.error is not None:
+            raise self.conn.pool.error
+        cur = self.conn.pool.db.execute(sql.replace('%s', '?'), tuple(args or ()))
+        self.rowcount = cur.rowcount
+        if cur.description:
+            names = [d[0] for d in cur.description]
+            self._rows = [dict(zip(names, r)) if self.dict_rows else tuple(r) for r in cur.fetchall()]
+        else:
+            self._rows = []
+
+    @asyncio.coroutine
+    def executemany(self, sql, args):
+        self.conn.pool.queries.append(sql)
+        cur = self.conn.pool.db.executemany(sql.replace('%s', '?'), [tuple(a) for a in args])
+        self.rowcount = cur.rowcount
+
+    @asyncio.coroutine
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    @asyncio.coroutine
+    def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    @asyncio.coroutine
+    def close(self):
+        pass
+
+class FakeConnection(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.closed = False
+
+    @asyncio.coroutine
+    def cursor(self, cls=None):
+        return FakeCursor(self, cls in (aiomysql.DictCursor, aiomysql.SSDictCursor))
+
+    @asyncio.coroutine
+    def begin(self):
+        pass
+
+    @asyncio.coroutine
+    def commit(self):
+        self.pool.db.commit()
+
+    @asyncio.coroutine
+    def rollback(self):
+        self.pool.db.rollback()
+
+    @asyncio.coroutine
+    def ping(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class FakePool(object):
+    '''
+    Mimics the part of aiomysql.Pool that orm.Pool uses.
+    Set error to make every query fail with that exception.
+    '''
+
+    def __init__(self, name, models=(), maxsize=10):
+        self.name = name
+        self.db = sqlite3.connect(':memory:', isolation_level=None)
+        for model in models:
+            create_table(self.db, model)
+        self.maxsize = maxsize
+        self.used = 0
+        self.free = 0
+        self.queries = []
+        self.error = None
+
+    @property
+    def size(self):
+        return self.used + self.free
+
+    @property
+    def freesize(self):
+        return self.free
+
+    @asyncio.coroutine
+    def acquire(self):
+        while self.used >= self.maxsize:
+            yield from asyncio.sleep(0.001)
+        if self.free:
+            self.free -= 1
+        self.used += 1
+        return FakeConnection(self)
+
+    def release(self, conn):
+        self.used -= 1
+        if not conn.closed:
+            self.free += 1
+
+    @asyncio.coroutine
+    def clear(self):
+        self.free = 0
+
+    def insert(self, model, rows):
+        cols = [model.__primary_key__] + list(model.__fields__)
+        self.db.executemany('insert into `%s` (%s) values (%s)' % (model.__table__, ', '.join(['`%s`' % c for c in cols]), ', '.join(['?'] * len(cols))), [tuple(r.get(c) for c in cols) for r in rows])
+
+def pool(name, models=(), **kw):
+    'Wrap a FakePool the way create_pool wraps an aiomysql pool.'
+    return www.orm.Pool(name, FakePool(name, models, kw.get('maxsize', 10)), 1, kw.get('maxsize', 10), kw.get('acquire_timeout'))
+
+# 把orm的全局状态设成给定的主库、从库和分片，返回一个可以恢复原状的函数
+def install(primary, replicas=(), shards=None):
+    saved = dict((k, getattr(www.orm, k, None)) for k in ('__pool', '_replicas', '_shards', '_counters', '_query_cache', '_fanout'))
+    setattr(www.orm, '__pool', primary)
+    www.orm._replicas = [www.orm.Replica(p.name, p) for p in replicas]
+    www.orm._shards = shards or {}
+    www.orm._counters = {}
+    www.orm._query_cache = None
+    www.orm._fanout = 4
+    def restore():
+        for k, v in saved.items():
+            setattr(www.orm, k, v)
+    return restore
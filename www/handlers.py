@@ -5,17 +5,26 @@ __author__ = 'James Z'
 
 ' url handlers '
 
-import re, time, json, logging, hashlib, base64, asyncio
-from www.markdown_highlight import markdown_highlight
+import re, time, logging, hashlib, base64, asyncio
+from www.markdown_highlight import render_markdown
 from aiohttp import web
 from www.coroweb import get, post
-from www.apis import Page,APIValueError, APIResourceNotFoundError, APIError, APIPermissionError
+from www.apis import Page, decode_cursor, APIValueError, APIResourceNotFoundError, APIError, APIPermissionError
 from www.models import User, Comment, Blog, next_id
+from www.orm import gather, query_cache_stats, pool_stats
 from www.config import configs
+from www.cache import LRUCache
+from www.serializers import dumps
 
 COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret
 
+# 已验证过的cookie -> user，重复访问不必再查库和重新计算sha1，tag为uid
+_SESSION_CACHE = LRUCache(configs.session.cache_size, configs.session.cache_ttl)
+
+# 匿名用户看到的整页缓存：(path, query_string) -> (content_type, charset, body)，tag为path
+PAGE_CACHE = LRUCache(configs.page_cache.maxsize, configs.page_cache.ttl)
+
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 
@@ -33,6 +42,22 @@ def get_page_index(page_str):
         p = 1
     return p
 
+# 分页查询：传了cursor就按(created_at, id)定位，否则沿用page=的offset分页，两种方式都会返回next/prev游标
+# 总数和当前页互不依赖，两个查询并发执行
+@asyncio.coroutine
+def find_page(model, page_str='1', cursor=None, page_size=5, **kw):
+    page_index = get_page_index(page_str)
+    if cursor:
+        direction, _, created_at, pk = decode_cursor(cursor)
+        query = model.findAll(seek=(created_at, pk), reverse=direction == 'p', limit=page_size + 1, **kw)
+    else:
+        query = model.findAll(orderBy='created_at desc, id desc', limit=(page_size * (page_index - 1), page_size), **kw)
+    num, items = yield from gather(model.findNumber('count(id)'), query)
+    p = Page(num, page_index, page_size, cursor=cursor)
+    if num == 0 or p.limit == 0:
+        return p, []
+    return p, p.paginate(items)
+
 def user2cookie(user, max_age):
     '''
     Generate cookie str by user.
@@ -47,6 +72,28 @@ def text2html(text):
     lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
     return ''.join(lines)
 
+# 博客正文用markdown加代码高亮，评论只做转义；都在写入时渲染一次，存到html_content
+def blog2html(content):
+    return render_markdown(content)
+
+def comment2html(content):
+    return text2html(content)
+
+def cache_session(cookie_str, user, expires):
+    ttl = min(configs.session.cache_ttl, expires - time.time())
+    if ttl <= 0:
+        return
+    _SESSION_CACHE.set(cookie_str, user, ttl, tags=(user.id,))
+
+# 用户被修改或删除时调用，让该用户所有缓存的会话重新走数据库验证
+def invalidate_user_sessions(uid):
+    _SESSION_CACHE.invalidate(uid)
+
+# 写操作后调用，丢掉这些页面所有query_string下的缓存
+def invalidate_pages(*paths):
+    for path in paths:
+        PAGE_CACHE.invalidate(path)
+
 @asyncio.coroutine
 def cookie2user(cookie_str):
     '''
@@ -54,6 +101,9 @@ def cookie2user(cookie_str):
     '''
     if not cookie_str:
         return None
+    user = _SESSION_CACHE.get(cookie_str)
+    if user is not None:
+        return user
     try:
         L = cookie_str.split('-')
         if len(L) != 3:
@@ -69,20 +119,15 @@ def cookie2user(cookie_str):
             logging.info('invalid sha1')
             return None
         user.passwd = '******'
+        cache_session(cookie_str, user, int(expires))
         return user
     except Exception as e:
         logging.exception(e)
         return None
 
-@get('/')
-def index(*,page = '1'):# 去掉参数request
-    page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
-    page = Page(num,page_index)
-    if num == 0:
-        blogs = []
-    else:
-        blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+@get('/', cache=True)
+def index(*,page = '1', cursor=None):# 去掉参数request
+    page, blogs = yield from find_page(Blog, page, cursor, defer=('content', 'html_content'))
     return {
         '__template__': 'blogs.html',
         'page': page,
@@ -91,14 +136,14 @@ def index(*,page = '1'):# 去掉参数request
 
 # --------------------------------------------signin、signout-------------------------------------
 
-@get('/signin')
+@get('/signin', skip=('auth',))
 def signin():
     return {
         '__template__':'signin.html'
     }
 
 # 用户登录
-@post('/api/authenticate')
+@post('/api/authenticate', skip=('auth',))
 def authenticate(*,email,passwd):
     if not email:
         raise APIValueError('email','Invalid email.')
@@ -120,10 +165,10 @@ def authenticate(*,email,passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'# 将返回的实例的密码改成******，保证真实密码不泄露
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = dumps(user)
     return r
 
-@get('/signout')
+@get('/signout', skip=('auth',))
 def signout():
     #referer = request.headers.get('Referer')
     r = web.HTTPFound('/')
@@ -151,7 +196,9 @@ def api_create_blog(request, *, name, summary, content):
     if not content or not content.strip():
         raise APIValueError('content', 'content cannot be empty.')
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
+    blog.html_content = blog2html(blog.content)
     yield from blog.save()
+    invalidate_pages('/')
     return blog
 
 @get('/manage/blogs')
@@ -162,19 +209,19 @@ def manage_blogs(*, page='1'):
     }
 
 @get('/api/blogs/{id}')
-def api_get_blog(*, id):
-    blog = yield from Blog.find(id)
+def api_get_blog(request, *, id):
+    blog = yield from request.__loader__.load(Blog, id)
     return blog
 
-@get('/blog/{id}')
-def get_blog(id):
-    blog = yield from Blog.find(id)
-    comments = yield from Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+@get('/blog/{id}', cache=True)
+def get_blog(request, *, id):
+    blog, comments = yield from gather(request.__loader__.load(Blog, id), Comment.findAll('blog_id=?', [id], orderBy='created_at desc'))
+    # html_content在写入时已经渲染好，只有还没回填的旧数据才在这里临时渲染
     for c in comments:
-        c.html_content = text2html(c.content)
-    # blog.html_content = text2html(blog.content)
-    # blog.content = markdown_highlight(blog.content)
-    blog.html_content = text2html(blog.content)
+        if not c.html_content:
+            c.html_content = comment2html(c.content)
+    if not blog.html_content:
+        blog.html_content = blog2html(blog.content)
 
     return {
         '__template__': 'blog.html',
@@ -183,13 +230,8 @@ def get_blog(id):
     }
 
 @get('/api/blogs')
-def api_blogs(*, page = '1'):
-    page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, blogs=())
-    blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+def api_blogs(*, page='1', cursor=None):
+    p, blogs = yield from find_page(Blog, page, cursor, compact=True, defer=('content', 'html_content'))
     return dict(page=p, blogs=blogs)
 
 @post('/api/blogs/{id}')
@@ -205,14 +247,26 @@ def api_update_blog(request, *, id, name, summary, content):# 将id置为命名
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
+    blog.html_content = blog2html(blog.content)
     yield from blog.update()
+    invalidate_pages('/', '/blog/%s' % id)
     return blog
 
+# 评论按blog_id分片后和博客不在同一个库里，没法放进同一个事务
+# 所以先删博客再删评论：删评论失败时只会留下页面上看不到的评论，不会出现评论被删了博客还在
+@asyncio.coroutine
+def delete_blog(blog):
+    yield from blog.remove()
+    comments = yield from Comment.findAll('blog_id=?', [blog.id], columns=(), compact=True)
+    if comments:
+        yield from Comment.remove_many([c.id for c in comments])
+
 @post('/api/blogs/{id}/delete')
 def api_delete_blog(request, *, id):
     check_admin(request)
     blog = yield from Blog.find(id)
-    yield from blog.remove()
+    yield from delete_blog(blog)
+    invalidate_pages('/', '/blog/%s' % id)
     return dict(id=id)
 
 @get('/manage/blogs/edit')
@@ -242,6 +296,7 @@ def api_grant_user(request, *, id):
     else:
         user.admin = 0
     yield from user.update()
+    invalidate_user_sessions(id)
     return dict(id=id)
 
 @post('/api/users/{id}/delete')
@@ -249,6 +304,7 @@ def api_delete_user(request, *, id):
     check_admin(request)
     user = yield from User.find(id)
     yield from user.remove()
+    invalidate_user_sessions(id)
     return dict(id=id)
 
 @get('/manage/users')
@@ -258,23 +314,18 @@ def manage_users(*, page='1'):
         'page_index': get_page_index(page)
     }
 
-@get('/register')
+@get('/register', skip=('auth',))
 def register():
     return {
         '__template__':'register.html'
     }
 
 @get('/api/users')
-def api_get_users(*,page='1'):
-    page_index = get_page_index(page)
-    num = yield from User.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, users=())
-    users = yield from User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+def api_get_users(*, page='1', cursor=None):
+    p, users = yield from find_page(User, page, cursor, compact=True)
     return dict(page=p, users=users)
 
-@post('/api/users')
+@post('/api/users', skip=('auth',))
 def api_register_user(*, email, name, passwd):
     if not name or not name.strip():
         raise APIValueError('name')
@@ -294,7 +345,7 @@ def api_register_user(*, email, name, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = dumps(user)
     return r
 
 # ----------------------------------------comments-------------------------------------------------------
@@ -306,15 +357,18 @@ def manage_comments(*, page='1'):
     }
 
 @get('/api/comments')
-def api_get_comments(*,page='1'):
-    page_index = get_page_index(page)
-    num = yield from Comment.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, comments=())
-    comments = yield from Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+def api_get_comments(*, page='1', cursor=None):
+    p, comments = yield from find_page(Comment, page, cursor, compact=True, defer=('html_content',))
     return dict(page=p, comments=comments)
 
+# 导出全部评论，每行一个JSON(NDJSON)，边读边写
+@get('/api/comments/export')
+def api_export_comments(request):
+    check_admin(request)
+    comments = Comment.iter_all(orderBy='created_at', compact=True)
+    comments.ndjson = True
+    return comments
+
 @post('/api/blogs/{id}/comments')
 def api_create_comment(request, *,id, content):
     user = request.__user__
@@ -322,12 +376,14 @@ def api_create_comment(request, *,id, content):
         raise APIPermissionError('Please signin first.')
     if not content or not content.strip():
         raise APIValueError('content')
-    blog = yield from Blog.find(id)
+    blog = yield from request.__loader__.load(Blog, id)
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image,
                       content=content.strip())
+    comment.html_content = comment2html(comment.content)
     yield from comment.save()
+    invalidate_pages('/blog/%s' % blog.id)
     return comment
 
 @post('/api/comments/{id}/delete')
@@ -337,4 +393,17 @@ def api_delete_comments(request, *, id):
     if c is None:
         raise APIResourceNotFoundError('Comment')
     yield from c.remove()
-    return dict(id=id)
\ No newline at end of file
+    invalidate_pages('/blog/%s' % c.blog_id)
+    return dict(id=id)
+
+# ----------------------------------------cache-------------------------------------------------------
+
+@get('/api/cache/stats')
+def api_cache_stats(request):
+    check_admin(request)
+    return dict(pages=PAGE_CACHE.stats(), sessions=_SESSION_CACHE.stats(), queries=query_cache_stats())
+
+@get('/api/pool/stats')
+def api_pool_stats(request):
+    check_admin(request)
+    return dict(pools=pool_stats())
@@ -1,7 +1,12 @@
+import hashlib
+
 import mistune
 from pygments import highlight
-from pygments.lexers import get_lexer_by_name
+from pygments.lexers import get_lexer_by_name, TextLexer
 from pygments.formatters.html import HtmlFormatter
+from pygments.util import ClassNotFound
+
+from www.cache import LRUCache
 
 class HighlightRenderer(mistune.Renderer):
     def block_code(self, code, lang):
@@ -13,7 +18,23 @@ class HighlightRenderer(mistune.Renderer):
         elif code.lstrip().startswith(('function', 'var', '$')):
             guess = 'javascript'
 
-        lexer = get_lexer_by_name(lang or guess, stripall=True)
+        # pygments不认识的语言(比如mermaid)按纯文本输出，不能让整篇文章渲染失败
+        try:
+            lexer = get_lexer_by_name(lang or guess, stripall=True)
+        except ClassNotFound:
+            lexer = TextLexer(stripall=True)
         return highlight(code, lexer, HtmlFormatter())
 
-markdown_highlight = mistune.Markdown(renderer=HighlightRenderer(), hard_wrap=True)
\ No newline at end of file
+# escape=True：文章里的原始html按文本输出，不能变成页面上的标签(比如<script>)
+markdown_highlight = mistune.Markdown(renderer=HighlightRenderer(escape=True), hard_wrap=True)
+
+# 按内容的sha1缓存渲染结果，同样的文本只渲染一次
+_RENDER_CACHE = LRUCache(256)
+
+def render_markdown(text):
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    html = _RENDER_CACHE.get(key)
+    if html is None:
+        html = markdown_highlight(text)
+        _RENDER_CACHE.set(key, html)
+    return html
\ No newline at end of file
@@ -16,6 +16,8 @@ def next_id():
 
 class User(Model):
     __table__ = 'users'
+    __indexes__ = ('created_at',)
+    __unique_indexes__ = ('email',)
 
     id = StringField(primary_key = True, default = next_id(), ddl = 'varchar(50)')
     email = StringField(ddl='varchar(50)')
@@ -27,6 +29,7 @@ class User(Model):
 
 class Blog(Model):
     __table__ = 'blogs'
+    __indexes__ = ('created_at',)
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
@@ -35,10 +38,16 @@ class Blog(Model):
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
+    html_content = TextField()# 写入时渲染好的html
     created_at = FloatField(default=time.time)
 
 class Comment(Model):
     __table__ = 'comments'
+    # 按blog_id分片，配置了configs.db.shards['comments']时生效
+    __shard_key__ = 'blog_id'
+    __shards__ = 'comments'
+    # get_blog按blog_id查评论并按created_at排序
+    __indexes__ = ('created_at', ('blog_id', 'created_at'))
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
@@ -46,4 +55,5 @@ class Comment(Model):
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
+    html_content = TextField()# 写入时渲染好的html
     created_at = FloatField(default=time.time)
\ No newline at end of file
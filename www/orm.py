@@ -3,10 +3,12 @@
 
 __author__ = 'James Z'
 
-import asyncio,logging
+import asyncio,logging,contextvars,heapq,itertools,re,time,zlib
 
 import aiomysql
 
+from www.cache import LRUCache
+
 def log(sql, args=()):
     logging.info('SQL:%s' % sql)
 
@@ -15,12 +17,40 @@ def log(sql, args=()):
 
 # 创建全局连接池，好处是不必频繁的打开和关闭数据库连接
 # 每个HTTP请求都可以从连接池中直接获取数据库连接
+# replicas为只读从库的配置列表，每项只需写和主库不同的部分(通常是host、port)
+# select()和find*默认读从库，写操作和事务走主库
+# acquire_timeout/query_timeout为取连接和执行一条sql的超时(秒)，adaptive为True时连接数在minsize和maxsize之间自动调整
 @asyncio.coroutine
 def create_pool(loop,**kw):
     log('create database connection pool……')
-    global __pool
+    global __pool, _fanout, _replicas, _replica_policy, _replica_lag, _shards, _query_timeout
+    # 一个请求里并发执行的查询最多占用的连接数，默认为连接池的1/4，避免一个请求占满连接池
+    _fanout = kw.get('fanout', max(1, kw.get('maxsize', 10) // 4))
+    _query_timeout = kw.get('query_timeout')
+    __pool = yield from _create_pool(loop, kw)
+    _replica_policy = kw.get('replica_policy', 'round_robin')
+    _replica_lag = kw.get('replica_lag', 1)
+    _replicas = []
+    for i, r in enumerate(kw.get('replicas', ())):
+        rkw = dict(kw)
+        rkw.update(r)
+        log('create replica connection pool %s:%s……' % (rkw.get('host', 'localhost'), rkw.get('port', 3306)))
+        _replicas.append(Replica('%s:%s' % (rkw.get('host', 'localhost'), rkw.get('port', 3306)), (yield from _create_pool(loop, rkw, 'replica'))))
+    # shards为分片组名 -> 每个分片的配置列表，同样只需写和主库不同的部分(host、port或db)
+    _shards = {}
+    for group, confs in kw.get('shards', {}).items():
+        pools = []
+        for c in confs:
+            skw = dict(kw)
+            skw.update(c)
+            log('create shard connection pool %s: %s:%s/%s……' % (group, skw.get('host', 'localhost'), skw.get('port', 3306), skw['db']))
+            pools.append((yield from _create_pool(loop, skw, 'shard %s' % group)))
+        _shards[group] = pools
+
+@asyncio.coroutine
+def _create_pool(loop, kw, role='primary'):
     # 调用一个子协程来创建全局连接池，create_pool返回一个pool实例对象
-    __pool= yield from aiomysql.create_pool(
+    pool = yield from aiomysql.create_pool(
         # 连接的基本属性设置
         host=kw.get('host', 'localhost'), # 数据库服务器位置，本地
         port=kw.get('port', 3306), # MySQL端口号
@@ -35,33 +65,647 @@ def create_pool(loop,**kw):
         minsize=kw.get('minsize',1), # 最小连接池大小，默认1
         loop=loop # 设置消息循环
     )
+    name = '%s %s:%s/%s' % (role, kw.get('host', 'localhost'), kw.get('port', 3306), kw['db'])
+    pool = Pool(name, pool, kw.get('minsize', 1), kw.get('maxsize', 10), kw.get('acquire_timeout'), kw.get('adaptive', False))
+    _pools.append(pool)
+    yield from pool.warm_up()
+    return pool
+
+class Pool(object):
+    '''
+    Wraps an aiomysql pool: records acquire latency, in-use/idle/waiting gauges and timeouts.
+
+    In adaptive mode connections are handed out up to a limit that moves between
+    minsize and maxsize, following the acquire wait time (see tune()).
+    '''
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)# 等待时间直方图的上界(秒)，最后一格为超过5秒
+
+    GROW_WAIT = 0.01# 一个周期内平均等待超过10毫秒就加连接
+
+    def __init__(self, name, pool, minsize, maxsize, acquire_timeout=None, adaptive=False):
+        self.name = name
+        self.pool = pool
+        self.minsize = max(1, minsize)
+        self.maxsize = maxsize
+        self.acquire_timeout = acquire_timeout
+        self.adaptive = adaptive
+        self.limit = self.minsize if adaptive else maxsize
+        self.in_use = 0
+        self.waiting = 0
+        self.timeouts = 0
+        self.acquired = 0
+        self.wait_total = 0.0
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+        self._window = [0, 0.0, 0, 0]# 本周期的: 取连接次数, 等待时间总和, 超时次数, 最大在用连接数
+        # 自适应模式下用信号量限制同时拿走的连接数，调大调小limit就是release/acquire信号量
+        self._slots = asyncio.Semaphore(self.limit) if adaptive else None
+
+    @property
+    def size(self):
+        return self.pool.size
+
+    @property
+    def freesize(self):
+        return self.pool.freesize
+
+    @asyncio.coroutine
+    def acquire(self):
+        start = time.time()
+        self.waiting += 1
+        try:
+            if self._slots is not None:
+                yield from asyncio.wait_for(self._slots.acquire(), self.acquire_timeout)
+            try:
+                timeout = self.acquire_timeout and max(0.001, self.acquire_timeout - (time.time() - start))
+                conn = yield from asyncio.wait_for(self.pool.acquire(), timeout)
+            except BaseException:
+                if self._slots is not None:
+                    self._slots.release()
+                raise
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._window[2] += 1
+            logging.warning('pool %s: acquire timed out after %ss, %s waiting' % (self.name, self.acquire_timeout, self.waiting))
+            raise PoolTimeout('pool %s: acquire timed out after %ss' % (self.name, self.acquire_timeout))
+        finally:
+            self.waiting -= 1
+        waited = time.time() - start
+        self.acquired += 1
+        self.wait_total += waited
+        self.histogram[next((i for i, b in enumerate(self.BUCKETS) if waited <= b), len(self.BUCKETS))] += 1
+        self.in_use += 1
+        w = self._window
+        w[0] += 1
+        w[1] += waited
+        w[3] = max(w[3], self.in_use)
+        return conn
+
+    def release(self, conn):
+        self.in_use -= 1
+        self.pool.release(conn)
+        if self._slots is not None:
+            self._slots.release()
+
+    # 支持with (yield from pool) as conn，和aiomysql的pool用法一样
+    def __iter__(self):
+        conn = yield from self.acquire()
+        return _Released(self, conn)
+
+    __await__ = __iter__
+
+    # 启动时把minsize个连接都取一遍并ping一下，第一批请求不用再等建连接
+    @asyncio.coroutine
+    def warm_up(self):
+        conns = []
+        try:
+            for i in range(self.minsize):
+                conns.append((yield from self.pool.acquire()))
+            for conn in conns:
+                yield from conn.ping()
+        finally:
+            for conn in conns:
+                self.pool.release(conn)
+
+    # 每个周期调一次：等待多或有超时就加连接，连接用不满就减，多出来的空闲连接关掉
+    @asyncio.coroutine
+    def tune(self):
+        count, waited, timeouts, peak = self._window
+        self._window = [0, 0.0, 0, self.in_use]
+        if not self.adaptive:
+            return
+        if (timeouts or (count and waited / count > self.GROW_WAIT)) and self.limit < self.maxsize:
+            grow = min(self.maxsize - self.limit, max(1, self.limit // 2))
+            self.limit += grow
+            for i in range(grow):
+                self._slots.release()
+            logging.info('pool %s: grow to %s' % (self.name, self.limit))
+        elif not timeouts and peak < self.limit // 2 and self.limit > self.minsize:
+            self.limit -= 1
+            asyncio.ensure_future(self._slots.acquire())# 等手上的连接还回来后收回一个名额
+            # 只关掉超出limit的空闲连接：从连接池取出来(空闲的会直接给出)，关掉后再还回去
+            for i in range(min(self.pool.freesize, self.pool.size - max(self.limit, self.minsize))):
+                conn = yield from self.pool.acquire()
+                conn.close()
+                self.pool.release(conn)
+            logging.info('pool %s: shrink to %s' % (self.name, self.limit))
+
+    def stats(self):
+        return dict(
+            name=self.name, size=self.pool.size, idle=self.pool.freesize, in_use=self.in_use, waiting=self.waiting,
+            limit=self.limit, minsize=self.minsize, maxsize=self.maxsize, adaptive=self.adaptive,
+            acquired=self.acquired, timeouts=self.timeouts,
+            avg_wait=self.wait_total / self.acquired if self.acquired else 0.0,
+            histogram=dict(zip(['<=%s' % b for b in self.BUCKETS] + ['>%s' % self.BUCKETS[-1]], self.histogram)))
+
+# 取连接超时：连接池被占满了，数据库本身不一定有问题
+class PoolTimeout(asyncio.TimeoutError):
+    pass
+
+class _Released(object):
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __enter__(self):
+        return self._conn
+
+    def __exit__(self, *args):
+        self._pool.release(self._conn)
+
+_pools = []
+_query_timeout = None
+
+def pool_stats():
+    return [p.stats() for p in _pools]
+
 @asyncio.coroutine
-def select(sql, args, size=None):
-    log(sql,args)
-    global __pool
-    with (yield from __pool) as conn:  # with...as...的作用就是try...exception...
-        # 打开一个DictCursor，以dict形式返回结果的游标
-        cur = yield from conn.cursor(aiomysql.DictCursor)
-        # sql的占位符为? 而MySQL的占位符为%s 替换
-        yield from cur.execute(sql.replace('?', '%s'), args or ())
-        # 如果size不为空，则取一定量的结果集
-        if size:
-            rs = yield from cur.fetchmany(size)
+def tune_pools_every(interval):
+    while True:
+        yield from asyncio.sleep(interval)
+        for p in _pools:
+            yield from p.tune()
+
+# 带超时执行sql，超时的连接上查询还在跑，关掉它而不是还给连接池
+@asyncio.coroutine
+def timed(coro, conn):
+    if not _query_timeout:
+        return (yield from coro)
+    try:
+        return (yield from asyncio.wait_for(coro, _query_timeout))
+    except asyncio.TimeoutError:
+        logging.warning('query timed out after %ss' % _query_timeout)
+        conn.close()
+        raise
+
+class Replica(object):
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.healthy = True
+
+    def busy(self):
+        return self.pool.size - self.pool.freesize
+
+_replicas = []
+_replica_policy = 'round_robin'
+_replica_lag = 1# 从库复制延迟的上限(秒)，表被写过之后这么久之内从从库读到的结果不进查询缓存
+_replica_next = 0
+
+# 连接层面的错误才把从库摘掉，sql本身的错误照常抛出
+# pymysql把没有专门异常类的服务端错误(1xxx，如1054列不存在、1205锁等待超时)也归为OperationalError，
+# 所以OperationalError只认客户端的2xxx错误码(连不上、连接断开等)
+# 超时不算：取连接超时只说明从库的连接池忙，一超时就摘掉会把流量全压到主库上；3.11起TimeoutError是OSError的子类，要先排除
+def is_connection_error(e):
+    if isinstance(e, asyncio.TimeoutError):
+        return False
+    if isinstance(e, (aiomysql.InterfaceError, OSError)):
+        return True
+    return isinstance(e, aiomysql.OperationalError) and bool(e.args) and isinstance(e.args[0], int) and 2000 <= e.args[0] < 3000
+
+# 选一个健康的从库：round_robin轮流使用，least_busy选正在使用的连接最少的
+def pick_replica():
+    global _replica_next
+    healthy = [r for r in _replicas if r.healthy]
+    if not healthy:
+        return None
+    if _replica_policy == 'least_busy':
+        return min(healthy, key=lambda r: r.busy())
+    _replica_next += 1
+    return healthy[_replica_next % len(healthy)]
+
+# 定期检查所有从库，出错的摘掉，恢复了再加回来
+# 任何异常都只摘掉对应的从库，不能让这个后台任务退出，否则摘掉的从库再也加不回来
+# 连接池忙取不到连接时不算检查失败，保持原来的状态
+@asyncio.coroutine
+def check_replicas_every(interval):
+    while True:
+        yield from asyncio.sleep(interval)
+        for r in _replicas:
+            try:
+                with (yield from r.pool) as conn:
+                    cur = yield from conn.cursor()
+                    yield from timed(cur.execute('select 1'), conn)
+                    yield from cur.close()
+                if not r.healthy:
+                    logging.info('replica %s is back' % r.name)
+                r.healthy = True
+            except PoolTimeout as e:
+                logging.info('replica %s check skipped: %s' % (r.name, e))
+            except Exception as e:
+                if r.healthy:
+                    logging.warning('replica %s ejected: %r' % (r.name, e))
+                r.healthy = False
+
+# 已编译语句的缓存：原始sql -> 驱动可直接执行的sql(占位符?换成MySQL的%s)
+# Model生成的sql都是有限的几种形状，缓存上限只是防止拼接了参数的sql把它撑爆
+_compiled = {}
+_COMPILED_MAX = 4096
+
+def compile_sql(sql):
+    s = _compiled.get(sql)
+    if s is None:
+        s = sql.replace('?', '%s')
+        if len(_compiled) < _COMPILED_MAX:
+            _compiled[sql] = s
+            _compiled[s] = s# 编译后的sql再传进来时直接命中
+    return s
+
+_fanout = 1
+
+# 当前任务所在的事务，事务中的select/execute都用事务固定的那个连接
+_transaction = contextvars.ContextVar('transaction', default=None)
+
+# 本次请求写过主库之后，后面的读也走主库，避免从库复制延迟读到旧数据
+_sticky = contextvars.ContextVar('sticky_primary', default=False)
+
+# keep-alive连接上的多个请求可能在同一个任务里处理，每个请求开始时清掉上一个请求留下的标记，
+# 结束时用返回的token调用end_sticky()恢复
+def begin_sticky():
+    return _sticky.set(False)
+
+def end_sticky(token):
+    _sticky.reset(token)
+
+# 本次请求接下来的读都走主库
+def stick_to_primary():
+    _sticky.set(True)
+
+# 事务中的连接不归还连接池，with结束时什么也不做
+class _Pinned(object):
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        return self._conn
+
+    def __exit__(self, *args):
+        pass
+
+# 取一个连接：在事务中返回事务的连接，否则从连接池取，用法同with (yield from __pool) as conn
+@asyncio.coroutine
+def connection():
+    shard = _shard.get()
+    if shard is not None:
+        return (yield from shard)
+    tx = _transaction.get()
+    if tx is not None:
+        return _Pinned(tx.conn)
+    return (yield from __pool)
+
+@asyncio.coroutine
+def acquire():
+    return (yield from __pool.acquire())
+
+def release(conn):
+    __pool.release(conn)
+
+class Transaction(object):
+    '''
+    Transaction pinned to one pooled connection, nested ones become savepoints.
+
+        async with orm.transaction():
+            ...
+
+    or, in generator based coroutines, yield from orm.atomic(coro).
+    '''
+
+    def __init__(self):
+        self.conn = None
+        self.level = 0# 嵌套层数，最外层为0
+        self.savepoint = None
+        self.tables = set()# 事务中写过的表，结束时让查询缓存再失效一次
+        self._token = None
+
+    @asyncio.coroutine
+    def begin(self):
+        parent = _transaction.get()
+        if parent is None:
+            self.conn = yield from acquire()
+            yield from self.conn.begin()
         else:
-            rs = yield from cur.fetchall()
+            # 嵌套的事务用savepoint，提交和回滚都只影响这一层
+            self.conn = parent.conn
+            self.level = parent.level + 1
+            self.savepoint = 'sp_%d' % self.level
+            yield from self._execute('savepoint %s' % self.savepoint)
+        self._token = _transaction.set(self)
+        return self
+
+    @asyncio.coroutine
+    def _execute(self, sql):
+        log(sql)
+        cur = yield from self.conn.cursor()
+        yield from cur.execute(sql)
         yield from cur.close()
-        logging.info('rows returned:%s' % len(rs))
-        return rs
+
+    @asyncio.coroutine
+    def commit(self):
+        try:
+            if self.savepoint:
+                yield from self._execute('release savepoint %s' % self.savepoint)
+            else:
+                yield from self.conn.commit()
+        finally:
+            self._end()
+
+    @asyncio.coroutine
+    def rollback(self):
+        try:
+            if self.savepoint:
+                yield from self._execute('rollback to savepoint %s' % self.savepoint)
+            else:
+                yield from self.conn.rollback()
+        finally:
+            self._end()
+
+    def _end(self):
+        _transaction.reset(self._token)
+        if self.savepoint is None:
+            release(self.conn)
+        # 提交(或回滚)之前别的请求可能又把旧数据缓存了
+        for table in self.tables:
+            invalidate_table(table)
+
+    __aenter__ = begin
+
+    @asyncio.coroutine
+    def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            yield from self.commit()
+        else:
+            yield from self.rollback()
+
+def transaction():
+    return Transaction()
+
+# 在一个事务中执行coro，成功则提交一次，出错回滚并继续抛出异常
+@asyncio.coroutine
+def atomic(coro):
+    tx = yield from transaction().begin()
+    try:
+        r = yield from coro
+    except BaseException:
+        yield from tx.rollback()
+        raise
+    yield from tx.commit()
+    return r
+
+# 并发执行几个互不依赖的查询，每个查询各用一个连接，同时进行的不超过_fanout个
+# 结果按传入的顺序返回，用法：blog, comments = yield from gather(Blog.find(id), Comment.findAll(...))
+# 在事务中只有一个连接，依次执行
+@asyncio.coroutine
+def gather(*coros):
+    if _transaction.get() is not None:
+        results = []
+        for coro in coros:
+            results.append((yield from coro))
+        return results
+    sem = asyncio.Semaphore(_fanout)
+    @asyncio.coroutine
+    def run(coro):
+        # with (yield from sem)在3.9里已经去掉了
+        yield from sem.acquire()
+        try:
+            return (yield from coro)
+        finally:
+            sem.release()
+    return (yield from asyncio.gather(*[run(coro) for coro in coros]))
+
+# ----------------------------------------分片----------------------------------------
+# model声明__shard_key__(分片键)和__shards__(分片组名)，配置了该组的连接池时按分片键的crc32取模路由
+# 带分片键的操作只访问一个分片，其余的分发到所有分片再合并结果
+_shards = {}
+_sharded_tables = {}# table -> 分片组名，resync_counters时要把各分片的行数加起来
+
+# 当前任务正在访问的分片连接池，设置后select/execute都用它
+_shard = contextvars.ContextVar('shard', default=None)
+
+# 需要路由时返回该model的分片连接池列表；没有分片或已经在某个分片上时返回None
+def shard_pools(cls):
+    if cls.__shard_key__ is None or _shard.get() is not None:
+        return None
+    return _shards.get(cls.__shards__) or None
+
+def shard_of(pools, value):
+    return pools[zlib.crc32(str(value).encode('utf-8')) % len(pools)]
+
+# 分片有自己的连接池，不在主库的事务里：事务中写分片表会直接提交，事务回滚时也撤不回来
+def check_shard_write():
+    if _shard.get() is not None and _transaction.get() is not None:
+        raise RuntimeError('cannot write to shard tables inside a transaction')
+
+# 在指定的分片上执行coro
+@asyncio.coroutine
+def on_shard(pool, coro):
+    token = _shard.set(pool)
+    try:
+        return (yield from coro)
+    finally:
+        _shard.reset(token)
+
+# 在所有分片上并发执行make()生成的coro，每个分片有自己的连接池，所以不受_fanout限制
+@asyncio.coroutine
+def scatter(pools, make):
+    return (yield from asyncio.gather(*[on_shard(pool, make()) for pool in pools]))
+
+# where以分片键=?开头(且没有or)时，返回分片键的值
+def shard_value(cls, where, args):
+    if where and args and ' or ' not in where.lower() and re.match(r'\s*`?%s`?\s*=\s*\?' % cls.__shard_key__, where):
+        return args[0]
+    return None
+
+# orderBy解析成[(列名, 是否倒序)]
+def parse_order(orderBy):
+    keys = []
+    for part in orderBy.split(','):
+        words = part.split()
+        keys.append((words[0].strip('`'), len(words) > 1 and words[1].lower() == 'desc'))
+    return keys
+
+# 各分片的结果已经按同样的顺序排好，k路归并成一个有序列表
+def merge_sorted(results, keys):
+    if not keys:
+        return list(itertools.chain(*results))
+    if len(set(desc for col, desc in keys)) == 1:
+        return list(heapq.merge(*results, key=lambda o: tuple(getattr(o, col) for col, desc in keys), reverse=keys[0][1]))
+    # 升降序混合时退回到多次稳定排序
+    rs = list(itertools.chain(*results))
+    for col, desc in reversed(keys):
+        rs.sort(key=lambda o: getattr(o, col), reverse=desc)
+    return rs
+
+# ----------------------------------------EXPLAIN检查----------------------------------------
+# 调试模式下每种sql第一次执行时先EXPLAIN一下，全表扫描或filesort时打警告
+_explain = False
+_explained = set()
+
+def enable_explain(enabled=True):
+    global _explain
+    _explain = enabled
+
+@asyncio.coroutine
+def explain(sql, args):
+    try:
+        rs = yield from select('explain %s' % sql, args, cache=False)
+    except Exception as e:
+        logging.warning('EXPLAIN failed: %s: %s' % (sql, e))
+        return
+    for r in rs:
+        extra = r.get('Extra') or ''
+        if r.get('type') == 'ALL' or 'filesort' in extra:
+            logging.warning('EXPLAIN %s: table=%s type=%s key=%s rows=%s extra=%s' % (sql, r.get('table'), r.get('type'), r.get('key'), r.get('rows'), extra))
+
+# ----------------------------------------查询结果缓存----------------------------------------
+# 按(分片, sql, 参数)缓存select的结果，按sql涉及的表打tag，写这些表时失效
+# 默认关闭，enable_query_cache()之后才生效；事务中的查询不走缓存
+_query_cache = None
+_versions = dict()# table -> 失效次数，查询期间表被写过就不缓存这次的结果
+_invalidated_at = dict()# table -> 最近一次失效的时间
+_sql_tables = dict()
+_RE_TABLES = re.compile(r'\b(?:from|join|into|update)\s+`?(\w+)`?', re.IGNORECASE)
+
+def enable_query_cache(maxsize=10000, maxbytes=64 * 1024 * 1024, ttl=60):
+    global _query_cache
+    _query_cache = LRUCache(maxsize, ttl, maxbytes)
+
+def query_cache_stats():
+    return _query_cache.stats() if _query_cache is not None else None
+
+# sql涉及的表
+def sql_tables(sql):
+    tables = _sql_tables.get(sql)
+    if tables is None:
+        tables = tuple(set(t.lower() for t in _RE_TABLES.findall(sql)))
+        if len(_sql_tables) < _COMPILED_MAX:
+            _sql_tables[sql] = tables
+    return tables
+
+def invalidate_table(table):
+    _versions[table] = _versions.get(table, 0) + 1
+    _invalidated_at[table] = time.time()
+    if _query_cache is not None:
+        _query_cache.invalidate(table)
+
+# 写操作之后调用，事务中的写还要记到事务上
+def invalidate_tables(sql):
+    tx = _transaction.get()
+    for table in sql_tables(sql):
+        invalidate_table(table)
+        if tx is not None:
+            tx.tables.add(table)
+
+# 结果集大致占用的字节数
+def result_size(rs):
+    size = 64
+    for r in rs:
+        size += 64 + sum(len(str(v)) for v in (r.values() if isinstance(r, dict) else r))
+    return size
+
+# ----------------------------------------合并并发的相同查询----------------------------------------
+# 同时到来的相同查询只发一次，后来的直接等第一个的结果
+# key中带上涉及的表的版本，写过之后再来的查询会重新发起，不会拿到写之前的结果
+_inflight = dict()
+
+@asyncio.coroutine
+def single_flight(key, sql, args, size=None, tuples=False):
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(route_select(sql, args, size, tuples))
+        _inflight[key] = task
+        def done(t):
+            if _inflight.get(key) is t:
+                del _inflight[key]
+        task.add_done_callback(done)
+    # shield: 某个调用方被取消时不能把大家共用的查询也取消掉
+    return (yield from asyncio.shield(task))
+
+# cache=False时不读也不写查询缓存，也不和别的查询合并，用于必须读到最新数据的地方
+# 命中缓存或合并时返回的结果集是共享的，调用方不要修改它
+@asyncio.coroutine
+def select(sql, args, size=None, tuples=False, cache=True):
+    sql = compile_sql(sql)
+    if _explain and sql not in _explained and not sql.startswith('explain '):
+        _explained.add(sql)
+        yield from explain(sql, args)
+    if not cache or _transaction.get() is not None:
+        return (yield from route_select(sql, args, size, tuples))
+    key = (id(_shard.get()), sql, tuple(args or ()), size, tuples)
+    sticky = _sticky.get()
+    # 写过主库的请求不读缓存：缓存里可能是写之后从还没同步的从库读来的旧数据
+    if _query_cache is not None and not sticky:
+        rs = _query_cache.get(key)
+        if rs is not None:
+            return rs
+    tables = sql_tables(sql)
+    versions = tuple(_versions.get(t, 0) for t in tables)
+    # 写过主库的请求读主库，不能和读从库的合并
+    rs = yield from single_flight(key + (bool(sticky), versions), sql, args, size, tuples)
+    if _query_cache is not None and versions == tuple(_versions.get(t, 0) for t in tables) and (sticky or not replica_lagging(tables)):
+        _query_cache.set(key, rs, tags=tables, size=result_size(rs))
+    return rs
+
+# 这些表刚写过，从库可能还没同步
+def replica_lagging(tables):
+    if not _replicas:
+        return False
+    now = time.time()
+    return any(now - _invalidated_at.get(t, 0) < _replica_lag for t in tables)
+
+# 不在事务中、本次请求也没写过主库时读从库，从库连接出错就摘掉它并改读主库
+# 取连接或查询超时只改读主库，不摘掉从库，由check_replicas_every判断它是否健康
+@asyncio.coroutine
+def route_select(sql, args, size=None, tuples=False):
+    log(sql,args)
+    replica = None
+    if _replicas and _transaction.get() is None and _shard.get() is None and not _sticky.get():
+        replica = pick_replica()
+    if replica is not None:
+        try:
+            with (yield from replica.pool) as conn:
+                return (yield from fetch(conn, sql, args, size, tuples))
+        except asyncio.TimeoutError as e:
+            logging.warning('replica %s timed out, reading from primary: %r' % (replica.name, e))
+        except Exception as e:
+            if not is_connection_error(e):
+                raise
+            logging.warning('replica %s ejected: %r' % (replica.name, e))
+            replica.healthy = False
+    with (yield from connection()) as conn:  # with...as...的作用就是try...exception...
+        return (yield from fetch(conn, sql, args, size, tuples))
+
+# tuples=True时用普通游标，每行是按select列顺序排列的tuple，省去DictCursor为每行建dict
+@asyncio.coroutine
+def fetch(conn, sql, args, size=None, tuples=False):
+    # 打开一个DictCursor，以dict形式返回结果的游标
+    cur = yield from conn.cursor(aiomysql.Cursor if tuples else aiomysql.DictCursor)
+    yield from timed(cur.execute(sql, args or ()), conn)
+    # 如果size不为空，则取一定量的结果集
+    if size:
+        rs = yield from cur.fetchmany(size)
+    else:
+        rs = yield from cur.fetchall()
+    yield from cur.close()
+    logging.info('rows returned:%s' % len(rs))
+    return rs
 
 # insert, update, delete通用函数
+# 在事务中时autocommit不起作用，由事务统一提交
 def execute(sql, args, autocommit=True):
+    sql = compile_sql(sql)
     log(sql)
-    with (yield from __pool) as conn:
+    check_shard_write()
+    if _transaction.get() is not None:
+        autocommit = True
+    _sticky.set(True)
+    with (yield from connection()) as conn:
         if not autocommit:
             yield from conn.begin()
         try:
             cur = yield from conn.cursor()
-            yield from cur.execute(sql.replace('?','%s'), args)
+            yield from timed(cur.execute(sql, args), conn)
             affected = cur.rowcount# execute()函数和select()函数所不同的是，cursor对象不返回结果集，而是通过rowcount返回结果数
             print('affected:',affected)
             yield from cur.close()
@@ -71,16 +715,277 @@ def execute(sql, args, autocommit=True):
             if not autocommit:
                 yield from conn.rollback()
             raise
+        finally:
+            invalidate_tables(sql)
         return affected
 
-#这个函数在元类中被引用，作用是将其占位符拼接起来成'?,?,?'的形式
+# 批量操作一个批次的上限：单条语句不能超过MySQL的max_allowed_packet，这里留出余量
+_BATCH_BYTES = 1024 * 1024 - 4096
+_BATCH_ROWS = 1000
+
+# 按大小把若干行参数切成批次
+def chunk_rows(rows, max_bytes=None, max_rows=None):
+    max_bytes = max_bytes or _BATCH_BYTES
+    max_rows = max_rows or _BATCH_ROWS
+    batch, size = [], 0
+    for row in rows:
+        n = sum(len(str(v).encode('utf-8')) + 4 for v in row)# 4是引号、逗号等的大致开销
+        if batch and (size + n > max_bytes or len(batch) >= max_rows):
+            yield batch
+            batch, size = [], 0
+        batch.append(row)
+        size += n
+    if batch:
+        yield batch
+
+# 在同一个连接上依次执行多个批次，batches中的每一项为(sql, args, many)
+# many为True时用executemany，args是多行参数；返回每个批次影响的行数
+@asyncio.coroutine
+def execute_batches(batches):
+    check_shard_write()
+    results = []
+    _sticky.set(True)
+    with (yield from connection()) as conn:
+        cur = yield from conn.cursor()
+        try:
+            for sql, args, many in batches:
+                sql = compile_sql(sql)
+                log(sql)
+                try:
+                    if many:
+                        yield from timed(cur.executemany(sql, args), conn)
+                    else:
+                        yield from timed(cur.execute(sql, args), conn)
+                finally:
+                    invalidate_tables(sql)
+                results.append(cur.rowcount)
+        finally:
+            yield from cur.close()
+    logging.info('batches affected: %s' % results)
+    return results
+
+# 行数计数器：table -> 行数。无条件的count(id)直接读这里，不必每次请求都全索引扫描
+# 第一次用到时从数据库加载，之后由Model.save()/remove()维护，resync_counters()定期和数据库对齐
+_counters = {}
+
+def count_rows(table, delta):
+    # 还没加载过的表不用维护，下次findNumber时会从数据库加载
+    if table in _counters:
+        _counters[table] += delta
+
+@asyncio.coroutine
+def resync_counters(tables=None):
+    for table in list(tables or _counters.keys()):
+        sql = 'select count(*) _num_ from `%s`' % table
+        pools = _shards.get(_sharded_tables.get(table))
+        if pools:
+            results = yield from scatter(pools, lambda: select(sql, None, 1, cache=False))
+            _counters[table] = sum(rs[0]['_num_'] for rs in results if rs)
+            continue
+        rs = yield from select(sql, None, 1, cache=False)
+        if len(rs) > 0:
+            _counters[table] = rs[0]['_num_']
+
+# 定期重新统计，纠正多进程部署或直接改库造成的偏差
+@asyncio.coroutine
+def resync_counters_every(interval):
+    while True:
+        yield from asyncio.sleep(interval)
+        try:
+            yield from resync_counters()
+        except Exception as e:
+            logging.exception(e)
+
+#这个函数在元类中被引用，作用是将其占位符拼接起来成'%s,%s,%s'的形式
+# 元类生成的语句直接使用MySQL的占位符%s，执行时不必再替换
 def create_args_string(num):
     L = []
     for n in range(num):
-        L.append('?')
-    #比如说num=3，那L就是['?','?','?']，通过下面这句代码返回一个字符串'?,?,?'
+        L.append('%s')
+    #比如说num=3，那L就是['%s','%s','%s']，通过下面这句代码返回一个字符串'%s,%s,%s'
     return ', '.join(L)
 
+# columns=要查的列，defer=不查的列，两者都转换成不查的列，按字段定义的顺序排列
+def deferred_fields(cls, columns=None, defer=None):
+    if columns is not None:
+        return tuple(f for f in cls.__fields__ if f not in columns)
+    if defer:
+        return tuple(f for f in cls.__fields__ if f in defer)
+    return ()
+
+# 带投影的select：不查的列用null占位，列的位置不变，tuple游标和__row__照常使用
+def select_columns(cls, defer):
+    if not defer:
+        return cls.__select__
+    cols = ['`%s`' % cls.__primary_key__] + [('null `%s`' if f in defer else '`%s`') % f for f in cls.__fields__]
+    return 'select %s from `%s`' % (', '.join(cols), cls.__table__)
+
+# 按查询形状缓存编译好的sql，build只在第一次遇到该形状时调用
+def cached_query(cls, key, build):
+    sql = cls.__queries__.get(key)
+    if sql is None:
+        sql = compile_sql(build())
+        if len(cls.__queries__) < _COMPILED_MAX:
+            cls.__queries__[key] = sql
+    return sql
+
+# ----------------------------------------服务端游标遍历----------------------------------------
+# 全表导出、回填之类的任务用：结果集留在MySQL那边，每次只取batch_size行，内存占用和表大小无关
+
+# 遍历用的连接池：在分片上就用该分片，能读从库就读从库
+def scan_pool():
+    shard = _shard.get()
+    if shard is not None:
+        return shard
+    if _replicas and not _sticky.get():
+        replica = pick_replica()
+        if replica is not None:
+            return replica.pool
+    return __pool
+
+class Scan(object):
+    '''
+    Async iterator over a query on an unbuffered server-side cursor, see Model.iter_all().
+
+    Rows are fetched batch_size at a time and one dedicated connection is held
+    until the scan is exhausted or closed. With several pools (shards) they are
+    scanned one after another.
+    '''
+
+    def __init__(self, sql, args, batch_size, pools, make, tuples=False):
+        self.sql = sql
+        self.args = args
+        self.batch_size = batch_size
+        self.pools = list(pools)
+        self.make = make
+        self.tuples = tuples
+        self.pool = None
+        self.conn = None
+        self.cur = None
+        self.rows = []
+        self.index = 0
+        self.done = False
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        while self.index >= len(self.rows):
+            if self.done:
+                raise StopAsyncIteration
+            yield from self._fetch()
+        r = self.rows[self.index]
+        self.index += 1
+        return self.make(r)
+
+    @asyncio.coroutine
+    def _fetch(self):
+        self.rows, self.index = [], 0
+        try:
+            if self.cur is None:
+                if not self.pools:
+                    self.done = True
+                    return
+                self.pool = self.pools.pop(0)
+                self.conn = yield from self.pool.acquire()
+                self.cur = yield from self.conn.cursor(aiomysql.SSCursor if self.tuples else aiomysql.SSDictCursor)
+                log(self.sql, self.args)
+                yield from timed(self.cur.execute(self.sql, self.args), self.conn)
+            self.rows = yield from timed(self.cur.fetchmany(self.batch_size), self.conn)
+            if not self.rows:
+                # 结果集读完了，关掉游标后连接可以照常还回连接池，接着遍历下一个分片
+                yield from self.cur.close()
+                self._release(False)
+        except BaseException:
+            self._release(True)
+            raise
+
+    # abort为True时结果集还没读完，连接上还有没收完的数据，直接关掉连接而不是把剩下的行都读完
+    # 这里没有yield，任务在这时被取消也不会漏还连接
+    def _release(self, abort):
+        conn, self.conn, self.cur = self.conn, None, None
+        if conn is not None:
+            if abort:
+                conn.close()
+            self.pool.release(conn)
+
+    @asyncio.coroutine
+    def aclose(self):
+        self.done = True
+        self.pools = []
+        self.rows = []
+        self._release(True)
+
+    # 没有遍历完也没有aclose()就被丢掉时兜底
+    def __del__(self):
+        if self.conn is not None:
+            self._release(True)
+
+# 延迟加载的列：同一次findAll查出来的对象共用一个Deferred，任何一个对象第一次load_deferred()时
+# 用一条where pk in (...)把这一批对象的延迟列全部取回来
+class Deferred(object):
+
+    def __init__(self, model, fields, objs):
+        self.model = model
+        self.fields = fields
+        self.objs = objs
+        self.loaded = False
+
+    @asyncio.coroutine
+    def load(self):
+        if not self.loaded:
+            yield from self.model.undefer(self.objs, self.fields)
+            self.loaded = True
+
+def is_deferred(obj, key):
+    d = getattr(obj, '_deferred', None)
+    return d is not None and not d.loaded and key in d.fields
+
+class Row(object):
+    '''
+    Compact row generated per model by ModelMetaclass, returned by findAll(compact=True).
+    '''
+    __slots__ = ('_deferred',)
+
+    @asyncio.coroutine
+    def load_deferred(self):
+        d = getattr(self, '_deferred', None)
+        if d is not None:
+            yield from d.load()
+
+    # 还没加载的延迟列没有赋值(见set_deferred)，访问时和Model一样报错，不会被当成数据库里的NULL
+    def __getattr__(self, key):
+        if key != '_deferred' and is_deferred(self, key):
+            raise AttributeError(r"'%s' is deferred, call load_deferred() first" % key)
+        raise AttributeError(r"'%s' object has no attribute '%s'" % (self.__class__.__name__, key))
+
+    def getValue(self, key):
+        return getattr(self, key, None)
+
+    def getValueOrDefault(self, key):
+        value = getattr(self, key, None)
+        if value is None:
+            field = self.__mappings__[key]
+            if field.default is not None:
+                value = field.default() if callable(field.default) else field.default
+                setattr(self, key, value)
+        return value
+
+    # 没有__dict__，json序列化时用它；还没加载的延迟列不输出
+    def to_dict(self):
+        return dict((k, getattr(self, k, None)) for k in self.__columns__ if not is_deferred(self, k))
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.to_dict())
+
+# 为每个model生成一个带__slots__的行类，__init__按select的列顺序接收参数
+# __init__用代码生成而不是循环setattr，数据库返回的tuple可以直接cls(*row)，比dict快好几倍
+def make_row_class(name, columns, mappings, primaryKey):
+    ns = {}
+    exec('def __init__(self, %s):\n    %s\n' % (', '.join(columns), '\n    '.join(['self.%s = %s' % (c, c) for c in columns])), ns)
+    return type('%sRow' % name, (Row,), dict(__slots__=tuple(columns), __init__=ns['__init__'], __columns__=tuple(columns), __mappings__=mappings, __primary_key__=primaryKey))
+
 class Field(object):
 
     def __init__(self, name, column_type, primary_key, default):#default 默认值
@@ -169,23 +1074,75 @@ class ModelMetaclass(type):
         # 构造默认的SELECT, INSERT, UPDATE和DELETE语句:
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
-        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
-        attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
+        attrs['__update__'] = 'update `%s` set %s where `%s`=%%s' % (tableName, ', '.join(map(lambda f: '`%s`=%%s' % (mappings.get(f).name or f), fields)), primaryKey)
+        attrs['__delete__'] = 'delete from `%s` where `%s`=%%s' % (tableName, primaryKey)
+        attrs['__find__'] = '%s where `%s`=%%s' % (attrs['__select__'], primaryKey)
+        attrs['__queries__'] = dict()# 查询形状 -> 编译好的sql
+        attrs['__shard_key__'] = attrs.get('__shard_key__', None)
+        attrs['__shards__'] = attrs.get('__shards__', tableName)
+        if attrs['__shard_key__']:
+            _sharded_tables[tableName] = attrs['__shards__']
+        # 声明的索引：__indexes__/__unique_indexes__中每项是一个列名或多个列名组成的tuple
+        # 统一成 索引名 -> (列名tuple, 是否唯一)，索引名为idx_加上列名，由schema.py同步到数据库
+        indexes = dict()
+        for unique, decl in ((False, attrs.get('__indexes__', ())), (True, attrs.get('__unique_indexes__', ()))):
+            for cols in decl:
+                cols = (cols,) if isinstance(cols, str) else tuple(cols)
+                for c in cols:
+                    if c not in mappings:
+                        raise RuntimeError('Index on unknown field: %s' % c)
+                indexes['idx_%s' % '_'.join(cols)] = (cols, unique)
+        attrs['__indexes__'] = indexes
+        # 和__select__的列顺序一致：主键在前
+        attrs['__row__'] = make_row_class(name, [primaryKey] + fields, mappings, primaryKey)
         return type.__new__(cls, name, bases, attrs)
 
 #当我们传入关键字参数metaclass时，它指示Python解释器在创建MyList时，要通过ListMetaclass.__new__()来创建。
+def set_deferred(obj, d):
+    # Model的__setattr__会写进dict，这里要绕过去，让_deferred不出现在json里
+    object.__setattr__(obj, '_deferred', d)
+    # 占位的null不留在对象里，访问时才能提示该列还没加载
+    if isinstance(obj, dict):
+        for f in d.fields:
+            obj.pop(f, None)
+    else:
+        for f in d.fields:
+            delattr(obj, f)
+
 class Model(dict, metaclass=ModelMetaclass):
 
+    _deferred = None
+    _dirty = None# 从数据库加载(或save)之后被修改过的字段，为None表示不跟踪，update()时写所有字段
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
 
+    # 从数据库返回的一行构造对象，并开始记录修改过的字段
+    @classmethod
+    def fromRow(cls, r):
+        obj = cls(**r)
+        object.__setattr__(obj, '_dirty', set())
+        return obj
+
+    def __setitem__(self, key, value):
+        if self._dirty is not None and (key not in self or self[key] != value):
+            self._dirty.add(key)
+        super(Model, self).__setitem__(key, value)
+
     #__getattr__,使d.k可以访问
     def __getattr__(self, key):
         try:
             return self[key]
         except KeyError:
+            if is_deferred(self, key):
+                raise AttributeError(r"'%s' is deferred, call load_deferred() first" % key)
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
+    @asyncio.coroutine
+    def load_deferred(self):
+        if self._deferred is not None:
+            yield from self._deferred.load()
+
     #d.k = v
     def __setattr__(self, key, value):
         self[key] = value
@@ -208,41 +1165,143 @@ class Model(dict, metaclass=ModelMetaclass):
     @asyncio.coroutine
     def findAll(cls, where=None, args=None, **kw):
         ' find objects by where clause. '
-        sql = [cls.__select__]#'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
+        pools = shard_pools(cls)
+        if pools:
+            return (yield from cls.findAllSharded(pools, where, args, **kw))
+        args = list(args) if args else []
+        # compact=True时返回__row__对象(只读列表、导出等大结果集用)，而不是dict子类的Model
+        compact = kw.get('compact', False)
+        # columns=/defer=只查部分列，其余的在load_deferred()时一次性批量加载
+        defer = deferred_fields(cls, kw.get('columns'), kw.get('defer'))
+        orderBy = kw.get('orderBy', None)
+        # seek=(created_at, id)时按游标定位(keyset分页)，避免大offset时MySQL扫描并丢弃前面的行
+        # reverse=True表示取游标之前的一页，结果仍按倒序返回
+        seek = kw.get('seek', None)
+        reverse = kw.get('reverse', False)
+        seekField = kw.get('seekField', 'created_at')
+        if seek is not None:
+            args.extend((seek[0], seek[0], seek[1]))
+        limit = kw.get('limit', None)
+        if limit is None:
+            limitForm = 0
+        # 如果limit为一个整数n，那就将查询结果的前n个结果返回
+        elif isinstance(limit, int):
+            limitForm = 1
+            args.append(limit)
+        # 如果limit为一个两个值的tuple，则前一个值代表索引，后一个值代表从这个索引开始要取的结果数
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            limitForm = 2
+            args.extend(limit)##用extend是为了把tuple的小括号去掉，因为args传参的时候不能包含tuple
+        else:
+            raise ValueError('Invalid limit value: %s' % str(limit))
+
+        def build():
+            sql = [select_columns(cls, defer)]#'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
+            w, o = where, orderBy
+            if seek is not None:
+                op, order = ('>', 'asc') if reverse else ('<', 'desc')
+                cond = '(`%s` %s ? or (`%s` = ? and `%s` %s ?))' % (seekField, op, seekField, cls.__primary_key__, op)
+                w = '(%s) and %s' % (w, cond) if w else cond
+                o = '`%s` %s, `%s` %s' % (seekField, order, cls.__primary_key__, order)
+            if w:
+                sql.append('where')
+                sql.append(w)
+            if o:
+                sql.append('order by')
+                sql.append(o)
+            if limitForm:
+                sql.append('limit')
+                sql.append('?' if limitForm == 1 else '?, ?')
+            return ' '.join(sql)
+
+        key = ('findAll', where, orderBy, limitForm, seek is not None and (seekField, reverse), defer)
+        rs = yield from select(cached_query(cls, key, build), args, tuples=compact)#sql语句和args都准备好了就交给select函数去执行
+        if seek is not None and reverse:
+            rs = rs[::-1]
+        if compact:
+            row = cls.__row__
+            objs = [row(*r) for r in rs]
+        else:
+            objs = [cls.fromRow(r) for r in rs]#将所有查询结果返回
+        if defer and objs:
+            d = Deferred(cls, defer, objs)
+            for obj in objs:
+                set_deferred(obj, d)
+        return objs
+
+    # 用服务端游标遍历所有符合条件的行：async for blog in Blog.iter_all('user_id=?', [uid])
+    # 不经过查询缓存，也不在事务中(占用单独的连接)；分片的表逐个分片遍历，orderBy只在每个分片内有效
+    @classmethod
+    def iter_all(cls, where=None, args=None, batch_size=1000, **kw):
+        ' iterate over objects by where clause on a server-side cursor. '
+        orderBy = kw.get('orderBy', None)
+        compact = kw.get('compact', False)
+        sql = [cls.__select__]
         if where:
             sql.append('where')
             sql.append(where)
-        if args is None:
-            args = []
-        orderBy = kw.get('orderBy', None)
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
+        pools = shard_pools(cls) or [scan_pool()]
+        if compact:
+            row = cls.__row__
+            make = lambda r: row(*r)
+        else:
+            make = cls.fromRow
+        return Scan(compile_sql(' '.join(sql)), args or (), batch_size, pools, make, compact)
+
+    # 分片的findAll：带分片键的只查一个分片，否则每个分片各取offset+n条，按orderBy归并后再截取
+    @classmethod
+    @asyncio.coroutine
+    def findAllSharded(cls, pools, where=None, args=None, **kw):
+        value = shard_value(cls, where, args)
+        if value is not None:
+            return (yield from on_shard(shard_of(pools, value), cls.findAll(where, args, **kw)))
         limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            # 如果limit为一个整数n，那就将查询结果的前n个结果返回
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            # 如果limit为一个两个值的tuple，则前一个值代表索引，后一个值代表从这个索引开始要取的结果数
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                args.extend(limit)##用extend是为了把tuple的小括号去掉，因为args传参的时候不能包含tuple
-            else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = yield from select(' '.join(sql), args)#sql语句和args都准备好了就交给select函数去执行
-        return [cls(**r) for r in rs]#将所有查询结果返回
+        start, end = 0, None
+        if isinstance(limit, int):
+            end = limit
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            start, end = limit[0], limit[0] + limit[1]
+            kw = dict(kw, limit=end)
+        results = yield from scatter(pools, lambda: cls.findAll(where, args, **kw))
+        if kw.get('seek') is not None:
+            # seek模式下各分片都按(seekField, 主键)倒序返回
+            keys = [(kw.get('seekField', 'created_at'), True), (cls.__primary_key__, True)]
+        else:
+            keys = parse_order(kw['orderBy']) if kw.get('orderBy') else []
+        merged = merge_sorted(results, keys)
+        if kw.get('seek') is not None and kw.get('reverse'):
+            # 取游标之前的一页时，各分片返回的是紧挨着游标的行，离游标最近的在归并结果的末尾
+            n = len(merged)
+            return merged[max(n - end, 0) if end is not None else 0:n - start]
+        return merged[start:end]
 
     @classmethod
     @asyncio.coroutine
     def findNumber(cls, selectField, where=None, args=None):
         ' find number by select and where. '
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]#cls.__table__ = tablename
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = yield from select(' '.join(sql), args, 1)
+        # 不带条件的count走计数器
+        if not where and selectField.replace(' ', '').lower() in ('count(*)', 'count(%s)' % cls.__primary_key__, 'count(`%s`)' % cls.__primary_key__):
+            if cls.__table__ not in _counters:
+                yield from resync_counters([cls.__table__])
+            return _counters.get(cls.__table__)
+        pools = shard_pools(cls)
+        if pools:
+            value = shard_value(cls, where, args)
+            if value is not None:
+                return (yield from on_shard(shard_of(pools, value), cls.findNumber(selectField, where, args)))
+            # 分发到所有分片时只能合并count/sum这类可以相加的结果
+            results = yield from scatter(pools, lambda: cls.findNumber(selectField, where, args))
+            return sum(n for n in results if n is not None)
+        def build():
+            sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]#cls.__table__ = tablename
+            if where:
+                sql.append('where')
+                sql.append(where)
+            return ' '.join(sql)
+        rs = yield from select(cached_query(cls, ('findNumber', selectField, where), build), args, 1)
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
@@ -250,17 +1309,102 @@ class Model(dict, metaclass=ModelMetaclass):
     # 按主键查找
     @classmethod
     @asyncio.coroutine
-    def find(cls, pk):
+    def find(cls, pk, **kw):
         ' find object by primary key. '
-        rs = yield from select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        pools = shard_pools(cls)
+        if pools:
+            # 只知道主键时不知道在哪个分片，每个分片都查一下
+            results = yield from scatter(pools, lambda: cls.find(pk, **kw))
+            return next((obj for obj in results if obj is not None), None)
+        defer = deferred_fields(cls, kw.get('columns'), kw.get('defer'))
+        if defer:
+            sql = cached_query(cls, ('find', defer), lambda: '%s where `%s`=?' % (select_columns(cls, defer), cls.__primary_key__))
+        else:
+            sql = cls.__find__
+        rs = yield from select(sql, [pk], 1)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        obj = cls.fromRow(rs[0])
+        if defer:
+            set_deferred(obj, Deferred(cls, defer, [obj]))
+        return obj
+
+    # 一条查询取回一批对象的指定列
+    @classmethod
+    @asyncio.coroutine
+    def undefer(cls, objs, fields):
+        ' load deferred fields of objects by primary keys. '
+        pools = shard_pools(cls)
+        if pools:
+            for pool, group in cls.groupByShard(pools, objs):
+                yield from on_shard(pool, cls.undefer(group, fields))
+            return
+        byPk = dict((obj.getValue(cls.__primary_key__), obj) for obj in objs)
+        # compact行的延迟列是没有赋值的，期间被删掉的行查不回来，先补成None
+        for obj in objs:
+            if not isinstance(obj, dict):
+                for f in fields:
+                    setattr(obj, f, None)
+        for batch in chunk_rows([(pk,) for pk in byPk]):
+            sql = cached_query(cls, ('undefer', fields, len(batch)), lambda: 'select `%s`, %s from `%s` where `%s` in (%s)' % (cls.__primary_key__, ', '.join(['`%s`' % f for f in fields]), cls.__table__, cls.__primary_key__, create_args_string(len(batch))))
+            rs = yield from select(sql, [pk for pk, in batch])
+            for r in rs:
+                obj = byPk[r[cls.__primary_key__]]
+                for f in fields:
+                    # 从数据库加载的值不算修改
+                    if isinstance(obj, dict):
+                        dict.__setitem__(obj, f, r[f])
+                    else:
+                        setattr(obj, f, r[f])
+
+    # 按主键批量查找，一批只发一条where pk in (...)，结果按pks的顺序返回，找不到的跳过
+    @classmethod
+    @asyncio.coroutine
+    def find_many(cls, pks):
+        ' find objects by primary keys. '
+        pools = shard_pools(cls)
+        if pools:
+            results = yield from scatter(pools, lambda: cls.find_many(pks))
+            found = dict((obj.getValue(cls.__primary_key__), obj) for obj in itertools.chain(*results))
+            return [found[pk] for pk in pks if pk in found]
+        found = {}
+        for batch in chunk_rows([(pk,) for pk in set(pks)]):
+            sql = cached_query(cls, ('find_many', len(batch)), lambda: '%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__, create_args_string(len(batch))))
+            rs = yield from select(sql, [pk for pk, in batch])
+            for r in rs:
+                found[r[cls.__primary_key__]] = cls.fromRow(r)
+        return [found[pk] for pk in pks if pk in found]
+
+    # 按分片键把对象分组，分片键为空的对象(例如分片键被延迟加载)放进每个分片
+    @classmethod
+    def groupByShard(cls, pools, objs):
+        groups = dict((id(pool), []) for pool in pools)
+        for obj in objs:
+            value = obj.getValue(cls.__shard_key__)
+            if value is None:
+                for pool in pools:
+                    groups[id(pool)].append(obj)
+            else:
+                groups[id(shard_of(pools, value))].append(obj)
+        return [(pool, groups[id(pool)]) for pool in pools if groups[id(pool)]]
+
+    # 实例方法按自己的分片键路由
+    @asyncio.coroutine
+    def onShard(self, coro):
+        pools = shard_pools(self.__class__)
+        if not pools:
+            return (yield from coro)
+        value = self.getValueOrDefault(self.__shard_key__)
+        if value is None:
+            raise ValueError('shard key %s is empty' % self.__shard_key__)
+        return (yield from on_shard(shard_of(pools, value), coro))
 
     # save、update、remove这三个方法需要管理员权限才能操作，所以不定义为类方法，需要创建实例之后才能调用
 
     @asyncio.coroutine
     def save(self):
+        if shard_pools(self.__class__):
+            return (yield from self.onShard(self.save()))
         # 我们在定义__insert__时,将主键放在了末尾.因为属性与值要一一对应,因此通过append的方式将主键加在最后
         # 使用getValueOrDefault方法,可以调用time.time这样的函数来获取值
         print("start save")
@@ -270,26 +1414,158 @@ class Model(dict, metaclass=ModelMetaclass):
         if rows != 1:
             logging.warning('failed to insert record: affected rows: %s' % rows)
         else:
+            count_rows(self.__table__, 1)
+            object.__setattr__(self, '_dirty', set())
             print('save sucess!')
 
+    # 以下三个批量方法每批一条语句，所有批次共用一个连接，返回每批影响的行数
+    @classmethod
+    @asyncio.coroutine
+    def save_many(cls, objs):
+        ' insert objects with multi-row INSERT statements. '
+        pools = shard_pools(cls)
+        if pools:
+            results = []
+            for pool, group in cls.groupByShard(pools, objs):
+                results.extend((yield from on_shard(pool, cls.save_many(group))))
+            return results
+        prefix, row = cls.__insert__.rsplit(' values ', 1)
+        rows = []
+        for obj in objs:
+            args = list(map(obj.getValueOrDefault, cls.__fields__))
+            args.append(obj.getValueOrDefault(cls.__primary_key__))
+            rows.append(args)
+        batches = []
+        for batch in chunk_rows(rows):
+            sql = cached_query(cls, ('insert', len(batch)), lambda: '%s values %s' % (prefix, ', '.join([row] * len(batch))))
+            batches.append((sql, [v for args in batch for v in args], False))
+        results = yield from execute_batches(batches)
+        count_rows(cls.__table__, sum(results))
+        return results
+
+    @classmethod
+    @asyncio.coroutine
+    def update_many(cls, objs):
+        ' update objects by primary key with executemany. '
+        pools = shard_pools(cls)
+        if pools:
+            results = []
+            for pool, group in cls.groupByShard(pools, objs):
+                results.extend((yield from on_shard(pool, cls.update_many(group))))
+            return results
+        rows = []
+        for obj in objs:
+            # 和update()一样：延迟列没加载时getValue拿到的是None，写回去会把这些列清空
+            deferred = [f for f in cls.__fields__ if is_deferred(obj, f)]
+            if deferred:
+                raise RuntimeError('deferred fields not loaded: %s' % ', '.join(deferred))
+            args = list(map(obj.getValue, cls.__fields__))
+            args.append(obj.getValue(cls.__primary_key__))
+            rows.append(args)
+        results = yield from execute_batches([(cls.__update__, batch, True) for batch in chunk_rows(rows)])
+        return results
+
+    @classmethod
+    @asyncio.coroutine
+    def remove_many(cls, pks):
+        ' delete objects by primary keys with where pk in (...). '
+        pools = shard_pools(cls)
+        if pools:
+            return list(itertools.chain(*(yield from scatter(pools, lambda: cls.remove_many(pks)))))
+        batches = []
+        for batch in chunk_rows([(pk,) for pk in pks]):
+            sql = cached_query(cls, ('delete', len(batch)), lambda: 'delete from `%s` where `%s` in (%s)' % (cls.__table__, cls.__primary_key__, create_args_string(len(batch))))
+            batches.append((sql, [pk for pk, in batch], False))
+        results = yield from execute_batches(batches)
+        count_rows(cls.__table__, -sum(results))
+        return results
+
     @asyncio.coroutine
     def update(self):
+        if shard_pools(self.__class__):
+            return (yield from self.onShard(self.update()))
         print('start update')
+        if self._dirty is None:
+            if self._deferred is not None and not self._deferred.loaded:
+                raise RuntimeError('deferred fields not loaded: %s' % ', '.join(self._deferred.fields))
+            sql, fields = self.__update__, self.__fields__
+        else:
+            # 只写修改过的字段，什么都没改就不访问数据库
+            fields = [f for f in self.__fields__ if f in self._dirty]
+            if not fields:
+                logging.info('nothing to update: %s' % self.getValue(self.__primary_key__))
+                return
+            cls = self.__class__
+            sql = cached_query(cls, ('update', tuple(fields)), lambda: 'update `%s` set %s where `%s`=?' % (cls.__table__, ', '.join(['`%s`=?' % (cls.__mappings__[f].name or f) for f in fields]), cls.__primary_key__))
         # 像time.time,next_id之类的函数在插入的时候已经调用过了,没有其他需要实时更新的值,因此调用getValue
-        args = list(map(self.getValue, self.__fields__))
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = yield from execute(self.__update__, args)
+        rows = yield from execute(sql, args)
         if rows != 1:
             logging.warning('failed to update by primary key: affected rows: %s' % rows)
         else:
+            if self._dirty is not None:
+                self._dirty.clear()
             print('update sucess!')
 
     @asyncio.coroutine
     def remove(self):
+        if shard_pools(self.__class__):
+            return (yield from self.onShard(self.remove()))
         print('start remove')
         args = [self.getValue(self.__primary_key__)]
         rows = yield from execute(self.__delete__, args)
         if rows != 1:
             logging.warning('failed to remove by primary key: affected rows: %s' % rows)
         else:
-            print('remove sucess!')
\ No newline at end of file
+            count_rows(self.__table__, -1)
+            print('remove sucess!')
+
+class Loader(object):
+    '''
+    Request-scoped identity map and batched primary-key loader.
+    '''
+
+    def __init__(self):
+        self._objs = dict()# (model, pk) -> 对象，找不到的记为None，同一个请求内不会重复查询
+        self._pending = dict()# (model, pk) -> 正在查询这个主键的Future
+
+    def prime(self, objs):
+        for obj in objs:
+            self._objs[(obj.__class__, obj.getValue(obj.__primary_key__))] = obj
+        return objs
+
+    @asyncio.coroutine
+    def load(self, cls, pk):
+        objs = yield from self.load_many(cls, [pk])
+        return objs[0]
+
+    # 只查identity map中没有的主键，并且合并成一条查询
+    # 别的调用正在查的主键不重复查，等它查完；它查询失败的话下一轮由自己重新查
+    @asyncio.coroutine
+    def load_many(self, cls, pks):
+        while True:
+            missing = [pk for pk in set(pks) if (cls, pk) not in self._objs and (cls, pk) not in self._pending]
+            if missing:
+                yield from self._fetch(cls, missing)
+            if all((cls, pk) in self._objs for pk in pks):
+                return [self._objs[(cls, pk)] for pk in pks]
+            pending = set(self._pending[(cls, pk)] for pk in set(pks) if (cls, pk) in self._pending)
+            for fut in pending:
+                yield from asyncio.shield(fut)
+
+    @asyncio.coroutine
+    def _fetch(self, cls, pks):
+        fut = asyncio.Future()
+        for pk in pks:
+            self._pending[(cls, pk)] = fut
+        try:
+            objs = yield from cls.find_many(pks)
+            # 查询成功之后才把没找到的记为None
+            for pk in pks:
+                self._objs[(cls, pk)] = None
+            self.prime(objs)
+        finally:
+            for pk in pks:
+                del self._pending[(cls, pk)]
+            fut.set_result(None)
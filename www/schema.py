@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'ZsnnsZ'
+
+'''
+Sync indexes declared on models (__indexes__ / __unique_indexes__) to the database.
+
+    python3 -m www.schema            # 创建缺少的索引
+    python3 -m www.schema --dry-run  # 只打印差异
+'''
+
+import www.orm
+import asyncio, sys, logging; logging.basicConfig(level=logging.INFO)
+from www.config import configs
+from www.models import User, Blog, Comment
+
+MODELS = (User, Blog, Comment)
+
+# 读出表上现有的索引：索引名 -> (列名tuple, 是否唯一)
+@asyncio.coroutine
+def existing_indexes(table):
+    rs = yield from www.orm.select('select index_name, column_name, non_unique from information_schema.statistics where table_schema=database() and table_name=? order by index_name, seq_in_index', [table])
+    indexes = dict()
+    for r in rs:
+        r = dict((k.lower(), v) for k, v in r.items())
+        cols, unique = indexes.get(r['index_name'], ((), not r['non_unique']))
+        indexes[r['index_name']] = (cols + (r['column_name'],), unique)
+    return indexes
+
+# 对比声明和现有的索引，缺少的用online DDL创建；同名但列不同的只警告，不自动删除
+@asyncio.coroutine
+def sync_indexes(model, dry_run=False):
+    table = model.__table__
+    existing = yield from existing_indexes(table)
+    for name, (cols, unique) in sorted(model.__indexes__.items()):
+        if name in existing:
+            if existing[name] != (cols, unique):
+                logging.warning('%s.%s differs: declared %s, found %s' % (table, name, (cols, unique), existing[name]))
+            continue
+        sql = 'alter table `%s` add %sindex `%s` (%s), algorithm=inplace, lock=none' % (table, 'unique ' if unique else '', name, ', '.join(['`%s`' % (model.__mappings__[c].name or c) for c in cols]))
+        logging.info('missing index %s.%s: %s' % (table, name, sql))
+        if not dry_run:
+            yield from www.orm.execute(sql, None)
+    for name in sorted(set(existing) - set(model.__indexes__) - set(['PRIMARY'])):
+        logging.info('index %s.%s is not declared on %s' % (table, name, model.__name__))
+
+@asyncio.coroutine
+def main(loop, dry_run):
+    yield from www.orm.create_pool(loop=loop, **configs.db)
+    for model in MODELS:
+        pools = www.orm.shard_pools(model)
+        if pools:
+            # 分片的表在每个分片上各同步一次
+            for pool in pools:
+                yield from www.orm.on_shard(pool, sync_indexes(model, dry_run))
+        else:
+            yield from sync_indexes(model, dry_run)
+
+loop = asyncio.get_event_loop()
+loop.run_until_complete(main(loop, '--dry-run' in sys.argv))
+loop.close()
+if loop.is_closed():
+    sys.exit(0)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'ZsnnsZ'
+
+'''
+JSON encoding shared by API responses, encodes straight to utf-8 bytes.
+'''
+
+import json
+
+from www.orm import Row
+from www.apis import Page
+
+# 装了orjson就用它，否则用标准库json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 类 -> 把该类对象转成dict的函数，第一次遇到某个类时生成
+_encoders = {Page: vars}
+
+# 为compact的行类生成编码函数：按__columns__直接取属性拼dict，不用逐个getattr
+# 有还没加载的延迟列时走to_dict()，去掉那些列
+def row_encoder(cls):
+    ns = {}
+    exec('def encode(o):\n    if getattr(o, "_deferred", None) is not None and not o._deferred.loaded:\n        return o.to_dict()\n    return {%s}\n' % ', '.join(['%r: o.%s' % (c, c) for c in cls.__columns__]), ns)
+    return ns['encode']
+
+def encoder(cls):
+    enc = _encoders.get(cls)
+    if enc is None:
+        if issubclass(cls, Row):
+            enc = row_encoder(cls)
+        elif hasattr(cls, 'to_dict'):
+            enc = cls.to_dict
+        else:
+            enc = vars
+        _encoders[cls] = enc
+    return enc
+
+def default(o):
+    enc = _encoders.get(o.__class__)
+    if enc is None:
+        try:
+            enc = encoder(o.__class__)
+        except TypeError:
+            raise TypeError('Object of type %s is not JSON serializable' % o.__class__.__name__)
+    return enc(o)
+
+# 复用同一个JSONEncoder，json.dumps()带参数时每次都会新建一个
+_json = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=default)
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, default=default)
+    return _json.encode(obj).encode('utf-8')
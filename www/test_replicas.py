@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'ZsnnsZ'
+
+'''
+Read routing to replicas: stickiness, ejection and re-admission.
+
+    python3 -m unittest www.test_replicas
+'''
+
+import asyncio, unittest
+
+import aiomysql
+
+import www.orm
+from www.fakedb import pool, install
+from www.models import Blog
+
+def blog(name):
+    return dict(id='1', user_id='u', user_name='u', user_image='', name=name, summary='', content='', html_content='', created_at=1.0)
+
+class ReplicaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.primary = pool('primary', [Blog])
+        self.replica = pool('replica', [Blog], maxsize=1, acquire_timeout=0.01)
+        self.primary.pool.insert(Blog, [blog('primary')])
+        self.replica.pool.insert(Blog, [blog('replica')])
+        self.restore = install(self.primary, [self.replica])
+        self.r = www.orm._replicas[0]
+
+    def tearDown(self):
+        self.restore()
+        self.loop.close()
+
+    def run_co(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def find(self):
+        return self.run_co(Blog.find('1')).name
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.find(), 'replica')
+
+    def test_round_robin(self):
+        other = pool('other', [Blog])
+        other.pool.insert(Blog, [blog('other')])
+        www.orm._replicas.append(www.orm.Replica('other', other))
+        self.assertEqual(set([self.find(), self.find()]), set(['replica', 'other']))
+
+    def test_sticky_until_request_ends(self):
+        # 同一个任务里先后处理两个请求(keep-alive)，第一个请求写过主库
+        @asyncio.coroutine
+        def requests():
+            token = www.orm.begin_sticky()
+            yield from www.orm.execute('update `blogs` set `name`=? where `id`=?', ['written', '1'])
+            first = yield from Blog.find('1')
+            www.orm.end_sticky(token)
+            token = www.orm.begin_sticky()
+            second = yield from Blog.find('1')
+            www.orm.end_sticky(token)
+            return first.name, second.name
+        self.assertEqual(self.run_co(requests()), ('written', 'replica'))
+
+    def test_connection_error_ejects(self):
+        self.replica.pool.error = aiomysql.OperationalError(2013, 'Lost connection to MySQL server during query')
+        self.assertEqual(self.find(), 'primary')
+        self.assertFalse(self.r.healthy)
+        self.assertEqual(self.find(), 'primary')
+
+    def test_sql_error_does_not_eject(self):
+        self.replica.pool.error = aiomysql.OperationalError(1054, "Unknown column 'html_content'")
+        with self.assertRaises(aiomysql.OperationalError):
+            self.find()
+        self.assertTrue(self.r.healthy)
+
+    def test_busy_pool_falls_back_without_ejecting(self):
+        conn = self.run_co(self.replica.acquire())
+        self.assertEqual(self.find(), 'primary')
+        self.assertTrue(self.r.healthy)
+        self.replica.release(conn)
+        self.assertEqual(self.find(), 'replica')
+
+    def check(self):
+        task = asyncio.ensure_future(www.orm.check_replicas_every(0.01), loop=self.loop)
+        self.run_co(asyncio.sleep(0.05))
+        # 检查任务遇到异常也不能退出
+        self.assertFalse(task.done())
+        task.cancel()
+        self.run_co(asyncio.gather(task, return_exceptions=True))
+
+    def test_health_check_readmits(self):
+        self.r.healthy = False
+        self.assertEqual(self.find(), 'primary')
+        self.check()
+        self.assertTrue(self.r.healthy)
+        self.assertEqual(self.find(), 'replica')
+
+    def test_health_check_ejects(self):
+        self.replica.pool.error = aiomysql.OperationalError(2003, "Can't connect to MySQL server")
+        self.check()
+        self.assertFalse(self.r.healthy)
+
+    def test_health_check_ignores_busy_pool(self):
+        conn = self.run_co(self.replica.acquire())
+        self.check()
+        self.assertTrue(self.r.healthy)
+        self.replica.release(conn)
+
+if __name__ == '__main__':
+    unittest.main()
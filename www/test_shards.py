@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'ZsnnsZ'
+
+'''
+Sharded comments on two stand-in schemas: routing, merged listings, seeks and counters.
+
+    python3 -m unittest www.test_shards
+'''
+
+import asyncio, unittest
+
+import www.orm
+from www.fakedb import pool, install
+from www.models import Comment
+
+# crc32取模后b0、b1落在c0，b4、b5落在c1
+BLOGS = ['b0', 'b1', 'b4', 'b5']
+
+class ShardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.shards = [pool('c0', [Comment]), pool('c1', [Comment])]
+        self.restore = install(pool('primary'), shards={'comments': self.shards})
+        # created_at为1..20，分布在4篇博客上
+        for i in range(1, 21):
+            c = Comment(id='%02d' % i, blog_id=BLOGS[i % 4], user_id='u', user_name='u', user_image='', content='c%d' % i, html_content='', created_at=float(i))
+            self.run_co(c.save())
+        for p in self.shards:
+            p.pool.queries = []
+
+    def tearDown(self):
+        self.restore()
+        self.loop.close()
+
+    def run_co(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def created(self, comments):
+        return [int(c.created_at) for c in comments]
+
+    def test_rows_spread_over_shards(self):
+        counts = [p.pool.db.execute('select count(*) from comments').fetchone()[0] for p in self.shards]
+        self.assertEqual(sum(counts), 20)
+        self.assertTrue(all(counts))
+
+    def test_shard_key_routes_to_one_shard(self):
+        comments = self.run_co(Comment.findAll('blog_id=?', ['b1'], orderBy='created_at'))
+        self.assertEqual(self.created(comments), [1, 5, 9, 13, 17])
+        target = www.orm.shard_of(self.shards, 'b1')
+        self.assertEqual([len(p.pool.queries) for p in self.shards], [1 if p is target else 0 for p in self.shards])
+
+    def test_global_listing_is_merged_in_order(self):
+        comments = self.run_co(Comment.findAll(orderBy='created_at desc', limit=5))
+        self.assertEqual(self.created(comments), [20, 19, 18, 17, 16])
+        comments = self.run_co(Comment.findAll(orderBy='created_at desc', limit=(5, 5)))
+        self.assertEqual(self.created(comments), [15, 14, 13, 12, 11])
+
+    def test_seek_forward(self):
+        comments = self.run_co(Comment.findAll(seek=(10.0, '10'), limit=3))
+        self.assertEqual(self.created(comments), [9, 8, 7])
+
+    def test_seek_reverse(self):
+        # 取游标之前的一页：紧挨着游标的3条，仍按倒序返回
+        comments = self.run_co(Comment.findAll(seek=(10.0, '10'), reverse=True, limit=3))
+        self.assertEqual(self.created(comments), [13, 12, 11])
+
+    def test_find_by_pk(self):
+        self.assertEqual(self.run_co(Comment.find('07')).content, 'c7')
+        self.assertIsNone(self.run_co(Comment.find('99')))
+
+    def test_counters_are_summed(self):
+        self.assertEqual(self.run_co(Comment.findNumber('count(id)')), 20)
+        self.assertEqual(self.run_co(Comment.findNumber('count(id)', 'blog_id=?', ['b4'])), 5)
+        self.run_co(Comment(id='21', blog_id='b0', user_id='u', user_name='u', user_image='', content='', html_content='', created_at=21.0).save())
+        self.assertEqual(self.run_co(Comment.findNumber('count(id)')), 21)
+        self.run_co(www.orm.resync_counters(['comments']))
+        self.assertEqual(www.orm._counters['comments'], 21)
+
+if __name__ == '__main__':
+    unittest.main()